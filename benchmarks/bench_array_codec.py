@@ -0,0 +1,98 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Compares bulk array.array encoding/decoding with the element-by-element path.
+#
+#   python benchmarks/bench_array_codec.py [element_count]
+
+import array
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from photon import protocol
+from photon.protocol import ByteReader, ByteWriter, calc_size
+
+
+def serialize_per_element(value):
+    buf = bytearray(calc_size(value, False))
+    out = ByteWriter(buf)
+    code = protocol._get_code_for_array_typecode(value.typecode)
+    func = protocol._get_serialize_func_for_code(code)
+
+    protocol._serialize_short(out, len(value), False)
+    protocol._serialize_byte(out, code, False)
+    for val in value:
+        func(out, val, False)
+
+    return buf
+
+
+def deserialize_per_element(buf):
+    reader = ByteReader(buf)
+    length = protocol._deserialize_short(reader)
+    code = protocol._deserialize_byte(reader)
+    func = protocol._get_deserialize_func_for_code(code)
+
+    result = array.array(protocol._get_array_typecode_for_code(code))
+    for i in range(length):
+        result.append(func(reader))
+
+    return result
+
+
+def serialize_bulk(value):
+    buf = bytearray(calc_size(value, False))
+    protocol._serialize_array(ByteWriter(buf), value, False)
+
+    return buf
+
+
+def deserialize_bulk(buf):
+    return protocol._deserialize_array(ByteReader(buf))
+
+
+def bench(name, func, arg, number):
+    best = min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+    print("{:<32} {:>10.1f} us".format(name, best * 1e6))
+
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    number = 20
+
+    for typecode in ('b', 'h', 'i', 'q', 'f', 'd'):
+        value = array.array(typecode, (i % 100 for i in range(count)))
+        encoded = serialize_bulk(value)
+
+        assert encoded == serialize_per_element(value)
+        assert deserialize_bulk(encoded) == deserialize_per_element(encoded)
+
+        print("array('{}') x {} ({} bytes)".format(typecode, count, len(encoded)))
+        slow = bench("  encode per element", serialize_per_element, value, number)
+        fast = bench("  encode bulk", serialize_bulk, value, number)
+        print("  encode speedup: {:.0f}x".format(slow / fast))
+        slow = bench("  decode per element", deserialize_per_element, encoded, number)
+        fast = bench("  decode bulk", deserialize_bulk, encoded, number)
+        print("  decode speedup: {:.0f}x".format(slow / fast))
+
+
+if __name__ == "__main__":
+    main()
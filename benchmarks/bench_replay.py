@@ -0,0 +1,94 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Decode and dispatch throughput: replays incoming frames of a capture (PhotonPeer.start_capture) as fast
+# as possible. Without a capture file one with synthetic events is generated.
+#
+#   python benchmarks/bench_replay.py [capture_file] [repeat]
+
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from photon import protocol
+from photon.capture import CaptureWriter, INCOMING, read_capture, replay
+from photon.enums import ConnectionProtocol
+from photon.listener import PeerListener
+from photon.operations import EventData
+from photon.peer import PhotonPeer
+
+EVENT_COUNT = 100000
+
+
+class CountingListener(PeerListener):
+    def __init__(self):
+        super().__init__()
+        self.events = 0
+        self.responses = 0
+
+    def debug_return(self, debug_level, message):
+        pass
+
+    def on_status_changed(self, status_code):
+        pass
+
+    def on_operation_response(self, operation_response):
+        self.responses += 1
+
+    def on_event(self, event_data):
+        self.events += 1
+
+
+def generate(path, count):
+    with CaptureWriter(path) as capture:
+        capture.incoming(bytes([0xFB, 0, 0, 0, 9, 0, 1, 0xF3, 1]))
+
+        for i in range(count):
+            event = EventData(i % 200, {1: i, 2: "player{}".format(i % 16), 3: float(i), 4: bytearray(32)})
+            body = bytearray(protocol.calc_size(event, False))
+            protocol._serialize_event_data(protocol.ByteWriter(body), event, False)
+
+            capture.incoming(bytes([0xFB]) + struct.pack(">i", 9 + len(body)) + bytes([0, 1, 0xF3, 4]) + body)
+
+
+def main():
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "bench.cap")
+        generate(path, EVENT_COUNT)
+
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    size = sum(len(frame) for _, direction, frame in read_capture(path) if direction == INCOMING)
+
+    for _ in range(repeat):
+        listener = CountingListener()
+        pp = PhotonPeer(ConnectionProtocol.Tcp, listener)
+
+        started = time.perf_counter()
+        count = replay(pp, path, None)
+        elapsed = time.perf_counter() - started
+
+        print("{} frames ({} events, {} responses) in {:.3f} s: {:.0f} frames/s, {:.1f} MB/s".format(
+            count, listener.events, listener.responses, elapsed, count / elapsed, size / elapsed / 1000000))
+
+
+if __name__ == "__main__":
+    main()
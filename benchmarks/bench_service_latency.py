@@ -0,0 +1,196 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Measures enqueue-to-socket and socket-to-callback latency against a local echo server,
+# once with the README style polling service thread (100 ms sleep) and once with start_service().
+#
+#   python benchmarks/bench_service_latency.py [operation_count]
+
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from photon import protocol
+from photon.enums import ConnectionProtocol, StatusCode
+from photon.listener import PeerListener
+from photon.operations import EventData
+from photon.peer import PhotonPeer
+
+OP_CODE = 7
+SEQ_KEY = 1
+SENT_AT_KEY = 2
+
+
+class EchoServer:
+    """
+    Answers init and sends every operation back as an event stamped with the time it was written to the socket.
+    """
+
+    def __init__(self):
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.bind(("127.0.0.1", 0))
+        self.listen_socket.listen(1)
+        self.port = self.listen_socket.getsockname()[1]
+        self.arrived_at = {}
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        connection, _ = self.listen_socket.accept()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            while True:
+                first = self.read(connection, 1)
+                if first[0] == 0xF0:
+                    self.read(connection, 4)
+                    continue
+
+                head = first + self.read(connection, 4)
+                frame = head + self.read(connection, struct.unpack(">i", head[1:5])[0] - 5)
+                arrived_at = time.perf_counter()
+
+                if frame[8] != 2:
+                    # init request, operations have message type 2
+                    connection.sendall(bytes([0xFB, 0, 0, 0, 9, 0, 1, 0xF3, 1]))
+                    continue
+
+                request = protocol.deserialize_op_request(memoryview(frame)[9:])
+                self.arrived_at[request.params[SEQ_KEY]] = arrived_at
+
+                event = EventData(request.op_code, {SEQ_KEY: request.params[SEQ_KEY], SENT_AT_KEY: 0.0})
+                body = bytearray(protocol.calc_size(event, False))
+                protocol._serialize_event_data(protocol.ByteWriter(body), event, False)
+
+                head = bytes([0xFB]) + struct.pack(">i", 9 + len(body)) + bytes([0, 1, 0xF3, 4])
+                struct.pack_into(">d", body, len(body) - 8, time.perf_counter())
+                connection.sendall(head + body)
+        except (OSError, IndexError):
+            pass
+
+    @staticmethod
+    def read(connection, count):
+        data = b""
+        while len(data) < count:
+            chunk = connection.recv(count - len(data))
+            if not chunk:
+                raise OSError("closed")
+            data += chunk
+
+        return data
+
+
+class LatencyListener(PeerListener):
+    def __init__(self):
+        super().__init__()
+        self.connected = threading.Event()
+        self.received = {}
+
+    def debug_return(self, debug_level, message):
+        pass
+
+    def on_status_changed(self, status_code):
+        if status_code == StatusCode.Connect:
+            self.connected.set()
+
+    def on_operation_response(self, operation_response):
+        pass
+
+    def on_event(self, event_data):
+        self.received[event_data.params[SEQ_KEY]] = time.perf_counter() - event_data.params[SENT_AT_KEY]
+
+
+class PollingServiceThread(threading.Thread):
+    def __init__(self, pp):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.pp = pp
+        self._run = True
+
+    def run(self):
+        while self._run:
+            self.pp.service()
+
+            time.sleep(100.0 / 1000.0)
+
+    def stop(self):
+        self._run = False
+
+
+def measure(mode, count):
+    server = EchoServer()
+    listener = LatencyListener()
+    pp = PhotonPeer(ConnectionProtocol.Tcp, listener)
+
+    if mode == "polling":
+        service_thread = PollingServiceThread(pp)
+        service_thread.start()
+    else:
+        pp.start_service()
+
+    pp.connect("127.0.0.1", server.port, "Bench")
+    listener.connected.wait(5)
+
+    enqueued_at = {}
+    for seq in range(count):
+        time.sleep(random.uniform(0, 0.03))
+        enqueued_at[seq] = time.perf_counter()
+        pp.op_custom(OP_CODE, {SEQ_KEY: seq, SENT_AT_KEY: 0}, True)
+
+    deadline = time.time() + 5
+    while len(listener.received) < count and time.time() < deadline:
+        time.sleep(0.01)
+
+    if mode == "polling":
+        service_thread.stop()
+        service_thread.join()
+    else:
+        pp.stop_service()
+
+    pp.disconnect()
+
+    report(mode, "enqueue -> socket", [server.arrived_at[seq] - enqueued_at[seq] for seq in server.arrived_at])
+    report(mode, "socket -> callback", list(listener.received.values()))
+
+
+def report(mode, name, samples):
+    samples = sorted(samples)
+    if not samples:
+        print("{:<8} {:<20} no samples".format(mode, name))
+        return
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1e3
+
+    print("{:<8} {:<20} n={:<4} p50={:8.3f} ms  p90={:8.3f} ms  max={:8.3f} ms"
+          .format(mode, name, len(samples), pick(0.5), pick(0.9), samples[-1] * 1e3))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    measure("polling", count)
+    measure("event", count)
+
+
+if __name__ == "__main__":
+    main()
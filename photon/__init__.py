@@ -15,4 +15,5 @@ limitations under the License.
 """
 
 __all__ = ["utils", "peer", "basepeer", "tpeer", "listener", "tconnect", "operations", "protocol", "support",
-           "typedict", "stats", "enums"]
\ No newline at end of file
+           "typedict", "stats", "enums", "framing", "asyncpeer", "reactor", "channels", "ratelimit",
+           "tracing", "logs", "capture"]
\ No newline at end of file
@@ -0,0 +1,368 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import collections
+import socket
+import time
+from photon import tpeer
+from photon.capture import CaptureWriter
+from photon.enums import ConnectionState, DebugLevel, StatusCode, TraceStage
+from photon.framing import FrameParser
+from photon.listener import PeerListener
+from photon.utils import signed_byte
+
+
+class AsyncTConnect(asyncio.Protocol):
+    """
+    TConnect counterpart living on an asyncio event loop instead of its own thread.
+    """
+
+    def __init__(self, pp, host, port, loop):
+        self.pp = pp
+        self.host = host
+        self.port = port
+        self.loop = loop
+
+        self.transport = None
+        self.is_connected = False
+        self.obsolete = False
+        self.writing_paused = False
+        self.parser = FrameParser()
+        self.closed = loop.create_future()
+
+    def is_running(self):
+        return self.is_connected and not self.obsolete
+
+    def start_connection(self):
+        self.obsolete = False
+        self.is_connected = False
+        self.loop.create_task(self._open())
+
+        return True
+
+    async def _open(self):
+        try:
+            await self.loop.create_connection(lambda: self, self.host, self.port)
+        except OSError as e:
+            if self.pp.debug_level >= DebugLevel.Error:
+                self.pp.enqueue_debug_return(DebugLevel.Error, "Connect failed. Exception: {}", e)
+
+            self.obsolete = True
+            self.pp.enqueue_status_callback(StatusCode.ExceptionOnConnect)
+            self.pp.enqueue_status_callback(StatusCode.Disconnect)
+
+            if not self.closed.done():
+                self.closed.set_result(None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.obsolete:
+            transport.close()
+            return
+
+        self.is_connected = True
+        self.pp.notify_service()
+
+    def data_received(self, data):
+        if self.pp.traffic_stats_enabled:
+            self.pp.traffic_stats_incoming.totalPacketCount += 1
+
+        hooks = self.pp.trace_hooks
+        if hooks:
+            received = time.perf_counter_ns()
+
+        capture = self.pp.capture
+
+        try:
+            messages = self.parser.feed(data, capture.incoming if capture is not None else None)
+        except ValueError as e:
+            if self.pp.debug_level >= DebugLevel.Error:
+                self.pp.enqueue_debug_return(DebugLevel.Error, "Receiving failed. {}", e)
+
+            self.stop_connection()
+            return
+
+        for message in messages:
+            self.pp.receive_incoming_commands(message)
+
+        if hooks:
+            self.pp.trace(TraceStage.Receive, received, time.perf_counter_ns(), len(data))
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.pp.notify_service()
+
+    def connection_lost(self, exc):
+        was_obsolete = self.obsolete
+
+        self.is_connected = False
+        self.obsolete = True
+
+        if not was_obsolete:
+            if exc is not None and self.pp.debug_level >= DebugLevel.Error:
+                self.pp.enqueue_debug_return(DebugLevel.Error, "Receiving failed. SocketException: {}", exc)
+
+            self.pp.enqueue_status_callback(StatusCode.Disconnect)
+
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def is_writable(self):
+        return not self.writing_paused
+
+    def send_tcp(self, data):
+        self.send_batch([data])
+
+    def send_batch(self, messages):
+        if self.obsolete or self.transport is None:
+            if self.pp.debug_level >= DebugLevel.Info:
+                self.pp.log(DebugLevel.Info, "Sending was skipped because connection is obsolete.",
+                            messages=len(messages))
+
+            return
+
+        # transport may keep a reference to unsent data, pooled buffers must not be handed over
+        messages = [bytes(data) if type(data) is memoryview else data for data in messages]
+
+        capture = self.pp.capture
+        if capture is not None:
+            for data in messages:
+                capture.outgoing(data)
+
+        self.transport.writelines(messages)
+
+        # syscalls are up to the transport
+        self.pp.send_stats.count_flush(len(messages), sum(len(data) for data in messages), 0)
+
+    def stop_connection(self):
+        self.obsolete = True
+
+        if self.transport is not None:
+            self.transport.close()
+        elif not self.closed.done():
+            self.closed.set_result(None)
+
+
+class AsyncPhotonPeer:
+    """
+    PhotonPeer for asyncio: the connection is an asyncio transport and all dispatching runs as loop callbacks,
+    so any number of peers share one event loop without extra threads.
+
+    Events reach listener's on_event (if a listener is given) and the events() async iterator.
+    """
+
+    def __init__(self, peer_listener=None, loop=None):
+        self.loop = loop
+        self.peer_listener = peer_listener
+
+        self.basePeer = tpeer.TPeer(_AsyncListener(self))
+        self.basePeer.connection_factory = self._create_connection
+        self.basePeer.wakeup = self._schedule_service
+
+        self.max_dispatch_per_service = None
+
+        self._service_scheduled = False
+        self._ping_timer = None
+        self._connect_future = None
+        self._response_futures = {}
+        self._events = None
+
+    def _get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+        return self.loop
+
+    def _create_connection(self, pp, host, port):
+        return AsyncTConnect(pp, host, port, self._get_loop())
+
+    def set_debug_level(self, debug_level):
+        self.basePeer.debug_level = debug_level
+
+    def start_capture(self, path):
+        """
+        Same as PhotonPeer.start_capture.
+        """
+        self.stop_capture()
+        self.basePeer.capture = CaptureWriter(path, self.basePeer)
+
+    def stop_capture(self):
+        capture = self.basePeer.capture
+        self.basePeer.capture = None
+
+        if capture is not None:
+            capture.close()
+
+    async def connect(self, host, port, app_id=None, timeout=None):
+        """
+        Returns True once the server has acknowledged the connection, False if connecting failed.
+        """
+        loop = self._get_loop()
+        self._connect_future = loop.create_future()
+
+        if not self.basePeer.connect(host, port, app_id):
+            return False
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._connect_future), timeout)
+        except asyncio.TimeoutError:
+            await self.disconnect()
+            return False
+
+    async def disconnect(self):
+        connection = self.basePeer._rt
+
+        self.basePeer.disconnect()
+        self._cancel_ping_timer()
+
+        if connection is not None:
+            await connection.closed
+
+        self.basePeer._state = ConnectionState.Disconnected
+        self._fail_pending(ConnectionError("Disconnected"))
+
+    async def op_custom(self, op_code, params, reliable, channel_id=0, wait_response=False):
+        """
+        Enqueues operation and sends it right away.
+        Returns enqueue result, or with wait_response the next OperationResponse for op_code.
+        """
+        future = None
+        if wait_response:
+            future = self._get_loop().create_future()
+            # keyed like decoded responses, by signed op code
+            self._response_futures.setdefault(signed_byte(op_code), collections.deque()).append(future)
+
+        if not self.basePeer.enqueue_operation(op_code, params, reliable, channel_id, False):
+            if future is not None:
+                self._response_futures[signed_byte(op_code)].remove(future)
+
+            return None if wait_response else False
+
+        self.service()
+
+        if future is None:
+            return True
+
+        return await future
+
+    def events(self):
+        """
+        Async iterator over incoming events. Events are buffered from the first call on.
+        """
+        if self._events is None:
+            self._events = asyncio.Queue()
+
+        return self._iterate_events()
+
+    async def _iterate_events(self):
+        while True:
+            event = await self._events.get()
+            if event is None:
+                return
+
+            yield event
+
+    def service(self):
+        self._service_scheduled = False
+
+        self.basePeer.dispatch_incoming_batch(self.max_dispatch_per_service)
+        self.basePeer.send_outgoing_commands()
+
+        if self.basePeer.incoming_list:
+            # max_dispatch_per_service left some, go on in the next loop iteration
+            self._schedule_service()
+
+        self._schedule_ping()
+
+    def _schedule_service(self):
+        if not self._service_scheduled and self.loop is not None:
+            self._service_scheduled = True
+            self.loop.call_soon(self.service)
+
+    def _schedule_ping(self):
+        self._cancel_ping_timer()
+
+        if self.basePeer._state == ConnectionState.Connected:
+            self._ping_timer = self.loop.call_later(self.basePeer.get_service_timeout(), self.service)
+
+    def _cancel_ping_timer(self):
+        if self._ping_timer is not None:
+            self._ping_timer.cancel()
+            self._ping_timer = None
+
+    def _fail_pending(self, exc):
+        if self._connect_future is not None and not self._connect_future.done():
+            self._connect_future.set_result(False)
+
+        for futures in self._response_futures.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc)
+
+        self._response_futures.clear()
+
+        if self._events is not None:
+            self._events.put_nowait(None)
+
+
+class _AsyncListener(PeerListener):
+    def __init__(self, peer):
+        super().__init__()
+        self.peer = peer
+
+    def debug_return(self, debug_level, message):
+        if self.peer.peer_listener is not None:
+            self.peer.peer_listener.debug_return(debug_level, message)
+
+    def on_status_changed(self, status_code):
+        future = self.peer._connect_future
+
+        if status_code == StatusCode.Connect:
+            if future is not None and not future.done():
+                future.set_result(True)
+        elif status_code == StatusCode.Disconnect:
+            self.peer.basePeer._state = ConnectionState.Disconnected
+            self.peer._cancel_ping_timer()
+            self.peer._fail_pending(ConnectionError("Disconnected"))
+
+        if self.peer.peer_listener is not None:
+            self.peer.peer_listener.on_status_changed(status_code)
+
+    def on_operation_response(self, operation_response):
+        futures = self.peer._response_futures.get(signed_byte(operation_response.op_code))
+        if futures:
+            future = futures.popleft()
+            if not future.done():
+                future.set_result(operation_response)
+
+        if self.peer.peer_listener is not None:
+            self.peer.peer_listener.on_operation_response(operation_response)
+
+    def on_event(self, event_data):
+        if self.peer._events is not None:
+            self.peer._events.put_nowait(event_data)
+
+        if self.peer.peer_listener is not None:
+            self.peer.peer_listener.on_event(event_data)
@@ -15,26 +15,50 @@ limitations under the License.
 """
 
 import abc
+import collections
+import itertools
 import threading
-from photon.enums import ConnectionState, DebugLevel, StatusCode
+import time
+from photon.enums import ConnectionState, DebugLevel, StatusCode, TraceStage
+from photon.logs import ListenerSink, LogRecord
 from photon.protocol import deserialize_op_response, deserialize_event_data
+from photon.stats import DispatchCounter, LatencyHistogram, ResponseTimer
+from photon.tracing import TracedLock
 from photon.utils import now_in_millis
 
+_peer_ids = itertools.count(1)
+
 
 class BasePeer:
     def __init__(self, peer_listener):
         self.peer_listener = peer_listener
+        self.peer_id = next(_peer_ids)
 
         self.debug_level = DebugLevel.Error
+        self.log_sink = ListenerSink(self)
         self.traffic_stats_enabled = False
+        self.response_times_enabled = False
+        self.trace_hooks = ()
+        self.numpy_arrays = False
+        self.lazy_event_params = False
+
+        self.event_handlers = {}
+        self.response_handlers = {}
+        self.ignored_event_codes = set()
+        self.ignored_op_codes = set()
+        self.drop_unhandled = False
+        self.event_counters = {}
+        self.response_counters = {}
 
         self._state = ConnectionState.Disconnected
 
         self._INIT_BYTES = bytearray([0] * 41)
 
-        self._action_queue = []
+        self._action_queue = collections.deque()
         self._action_queue_lock = threading.Lock()
 
+        self.wakeup = None
+
         self.m_applicationIsInitialized = False
 
         self.m_connectionTime = 0
@@ -45,6 +69,9 @@ class BasePeer:
         self.m_lowestRoundTripTime = 0
         self.m_highestRoundTripTimeVariance = 0
 
+        self.rtt_histogram = LatencyHistogram()
+        self.response_timer = ResponseTimer()
+
         self.m_warningSize = 100
         self.m_time_ping_interval = 1000
         self.m_channelCount = 2
@@ -52,16 +79,68 @@ class BasePeer:
     def get_local_ms_timestamp(self):
         return now_in_millis() - self.m_connectionTime
 
+    def notify_service(self):
+        """
+        Tells the service loop (if one is waiting, see PhotonPeer.service_forever) that there is work to do.
+        """
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def trace(self, stage, start_ns, end_ns, size, code=None):
+        for hook in self.trace_hooks:
+            hook.on_stage(stage, start_ns, end_ns, size, code)
+
+    def locked(self, lock, stage):
+        """
+        Returns context manager acquiring lock, which reports time waited for it to trace hooks if there are any.
+        """
+        if not self.trace_hooks:
+            return lock
+
+        return TracedLock(self, lock, stage)
+
+    @staticmethod
+    def message_code(payload):
+        """
+        Event or op code of an incoming message (payload as in receive_incoming_commands), None for other messages.
+        """
+        if len(payload) < 3 or payload[0] != 256 - 13 or payload[1] & 0x7F not in (3, 4):
+            return None
+
+        return payload[2] - 256 if payload[2] > 127 else payload[2]
+
     def enqueue_action_for_dispatch(self, action):
         with self._action_queue_lock:
             self._action_queue.append(action)
 
-    def enqueue_debug_return(self, debug_level, message):
+        self.notify_service()
+
+    def dispatch_actions(self):
+        """
+        Runs actions queued so far. The queue is swapped out under the lock and the actions run without it.
+        """
         with self._action_queue_lock:
-            self._action_queue.append(
-                lambda:
-                self.peer_listener.debug_return(debug_level, message)
-            )
+            if len(self._action_queue) == 0:
+                return
+
+            actions = self._action_queue
+            self._action_queue = collections.deque()
+
+        for action in actions:
+            action()
+
+    def log(self, debug_level, message, *args, **fields):
+        """
+        Emits a LogRecord to log_sink. Callers check debug_level first, message is formatted with args
+        only if the sink writes it out.
+        """
+        self.log_sink.emit(LogRecord(self.peer_id, debug_level, message, args, fields))
+
+    def enqueue_debug_return(self, debug_level, message, *args, **fields):
+        """
+        Same as log, for the connection thread: the record is deferred, see LogRecord.
+        """
+        self.log_sink.emit(LogRecord(self.peer_id, debug_level, message, args, fields, True))
 
     def enqueue_status_callback(self, status):
         with self._action_queue_lock:
@@ -70,6 +149,8 @@ class BasePeer:
                 self.peer_listener.on_status_changed(status)
             )
 
+        self.notify_service()
+
     @abc.abstractmethod
     def enqueue_operation(self, params, op_code, reliable, channel_id, encrypt, message_type=2):
         pass
@@ -99,14 +180,22 @@ class BasePeer:
         self.peer_listener.on_status_changed(StatusCode.Connect)
 
     def deserialize_message_and_callback(self, payload):
+        if type(payload) is tuple:
+            # queued while tracing, with time of receiving
+            payload, received_ns = payload
+
+            if self.trace_hooks:
+                self.trace(TraceStage.IncomingWait, received_ns, time.perf_counter_ns(), len(payload),
+                           self.message_code(payload))
+
         if len(payload) < 2:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error, "Incoming data too short! {}".format(len(payload)))
+                self.log(DebugLevel.Error, "Incoming data too short! {}", len(payload), size=len(payload))
             return False
 
         if payload[0] != 256 - 13 and payload[1] != 256 - 3:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error, "No regular operation message: {}".format(payload[0]))
+                self.log(DebugLevel.Error, "No regular operation message: {}", payload[0], size=len(payload))
             return False
 
         msg_type = payload[1] & 0x7F
@@ -117,24 +206,79 @@ class BasePeer:
                 if is_encrypted:
                     raise Exception("We don't supper encrypted connect yet")
                 else:
-                    payload = payload[2:]
+                    payload = memoryview(payload)[2:]
             except Exception as e:
                 if self.debug_level >= DebugLevel.Error:
-                    self.peer_listener.debug_return(DebugLevel.Error, e)
+                    self.log(DebugLevel.Error, e)
 
                 return False
 
         if msg_type == 3:
-            self.peer_listener.on_operation_response(deserialize_op_response(payload))
+            handler = self.select_handler(payload, self.response_handlers, self.ignored_op_codes,
+                                          self.response_counters, self.peer_listener.on_operation_response)
+            if handler is None:
+                pass
+            elif self.trace_hooks:
+                self.traced_callback(handler, payload, deserialize_op_response, self.numpy_arrays)
+            else:
+                handler(deserialize_op_response(payload, self.numpy_arrays))
         elif msg_type == 4:
-            self.peer_listener.on_event(deserialize_event_data(payload))
+            handler = self.select_handler(payload, self.event_handlers, self.ignored_event_codes,
+                                          self.event_counters, self.peer_listener.on_event)
+            if handler is None:
+                pass
+            elif self.trace_hooks:
+                self.traced_callback(handler, payload, deserialize_event_data, self.numpy_arrays,
+                                     self.lazy_event_params)
+            else:
+                handler(deserialize_event_data(payload, self.numpy_arrays, self.lazy_event_params))
         elif msg_type == 1:
             self.init_callback()
         elif msg_type == 7:
             print("Receive shared key")
         else:
             if self.debug_level >= DebugLevel.Error:
-                self.enqueue_debug_return(DebugLevel.Error, "unexpected msgType {}".format(msg_type))
+                self.enqueue_debug_return(DebugLevel.Error, "unexpected msgType {}", msg_type, msg_type=msg_type)
+
+    def traced_callback(self, handler, payload, deserialize, *args):
+        """
+        Decodes payload (header already stripped) and calls handler, reporting both stages to trace hooks.
+        """
+        code = payload[0] - 256 if payload[0] > 127 else payload[0]
+
+        start = time.perf_counter_ns()
+        data = deserialize(payload, *args)
+        decoded = time.perf_counter_ns()
+        handler(data)
+        end = time.perf_counter_ns()
+
+        self.trace(TraceStage.Decode, start, decoded, len(payload), code)
+        self.trace(TraceStage.Callback, decoded, end, len(payload), code)
+
+    def select_handler(self, payload, handlers, ignored, counters, default):
+        """
+        Picks callback for a message by the code in its first byte, before anything is decoded.
+        Returns None if the message should be dropped.
+        """
+        code = payload[0] - 256 if payload[0] > 127 else payload[0]
+
+        if code in ignored:
+            handler = None
+        else:
+            handler = handlers.get(code)
+            if handler is None and not self.drop_unhandled:
+                handler = default
+
+        counter = counters.get(code)
+        if counter is None:
+            counter = counters[code] = DispatchCounter()
+
+        if handler is not None:
+            counter.delivered += 1
+        else:
+            counter.dropped += 1
+
+        return handler
 
     @abc.abstractmethod
     def connect(self, host, port, app_id=None):
@@ -152,10 +296,18 @@ class BasePeer:
     def send_outgoing_commands(self):
         pass
 
+    @abc.abstractmethod
+    def get_service_timeout(self):
+        pass
+
     @abc.abstractmethod
     def dispatch_incoming_commands(self):
         pass
 
+    @abc.abstractmethod
+    def dispatch_incoming_batch(self, max_count=None):
+        pass
+
     def update_round_trip_time_and_variance(self, last_round_trip_time):
         if last_round_trip_time < 0:
             return
@@ -168,8 +320,11 @@ class BasePeer:
             self.m_roundTripTime += (last_round_trip_time - self.m_roundTripTime) / 8
             self.m_roundTripTimeVariance -= (last_round_trip_time - self.m_roundTripTime) / 4
 
-        if self.m_roundTripTime < self.m_lowestRoundTripTime:
-            self.m_lowestRoundTripTime = self.m_roundTripTime
+        # lowest of measured times, 0 until the first one
+        if self.rtt_histogram.count == 0 or last_round_trip_time < self.m_lowestRoundTripTime:
+            self.m_lowestRoundTripTime = last_round_trip_time
+
+        self.rtt_histogram.record(last_round_trip_time)
 
         if self.m_roundTripTimeVariance > self.m_highestRoundTripTimeVariance:
             self.m_highestRoundTripTimeVariance = self.m_roundTripTimeVariance
\ No newline at end of file
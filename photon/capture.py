@@ -0,0 +1,399 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from photon.enums import DebugLevel
+from photon.framing import HEADER_SIZE, PAYLOAD_OFFSET, PING_MAGIC
+from photon.protocol import deserialize_event_data, deserialize_op_request, deserialize_op_response
+
+INCOMING = 0
+OUTGOING = 1
+
+# file starts with magic and version, then records: direction, time.monotonic_ns(), frame length, frame
+_MAGIC = b"PHCAP"
+_VERSION = 1
+_HEADER = struct.Struct(">5sB")
+_RECORD = struct.Struct(">BQI")
+
+# message types in the index, PING for ping requests and results
+INIT_REQUEST = 0
+INIT_RESPONSE = 1
+OPERATION_REQUEST = 2
+OPERATION_RESPONSE = 3
+EVENT = 4
+PING = 255
+
+# code of messages that have no op or event code
+NO_CODE = 0x7FFF
+
+# sidecar index: magic, version, byte order (1 little endian), capture size indexed, record count, then columns
+_INDEX_MAGIC = b"PHIDX"
+_INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct(">5sBBQQ")
+_INDEX_COLUMNS = (("offsets", "Q"), ("timestamps", "Q"), ("directions", "B"), ("msg_types", "B"), ("codes", "h"))
+
+
+class CaptureWriter:
+    """
+    Appends whole frames (headers included) with direction and time to a capture file, see
+    PhotonPeer.start_capture. Connection thread writes incoming frames while outgoing come from the sending one.
+    A failed write (e.g. full disk) never reaches the connection: capturing stops and the error is logged to peer.
+    """
+
+    def __init__(self, path, peer=None):
+        self.peer = peer
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.file.write(_HEADER.pack(_MAGIC, _VERSION))
+
+    def write(self, direction, frame):
+        with self.lock:
+            if self.file is None:
+                return
+
+            try:
+                self.file.write(_RECORD.pack(direction, time.monotonic_ns(), len(frame)))
+                self.file.write(frame)
+            except (OSError, ValueError) as e:
+                self.failed(e)
+
+    def failed(self, e):
+        try:
+            self.file.close()
+        except (OSError, ValueError):
+            pass
+
+        self.file = None
+
+        if self.peer is not None:
+            if self.peer.capture is self:
+                self.peer.capture = None
+
+            if self.peer.debug_level >= DebugLevel.Error:
+                self.peer.enqueue_debug_return(DebugLevel.Error, "Capture failed, capturing stopped. {}", e)
+
+    def incoming(self, frame):
+        self.write(INCOMING, frame)
+
+    def outgoing(self, frame):
+        self.write(OUTGOING, frame)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_capture(path):
+    """
+    Yields (timestamp_ns, direction, frame) of every record in capture file at path. A record cut short
+    (the capturing process died while writing it) ends the capture.
+    """
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size or _HEADER.unpack(header)[0] != _MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+
+        version = _HEADER.unpack(header)[1]
+        if version != _VERSION:
+            raise ValueError("Unsupported capture version {}".format(version))
+
+        while True:
+            record = f.read(_RECORD.size)
+            if len(record) < _RECORD.size:
+                return
+
+            direction, timestamp, length = _RECORD.unpack(record)
+
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+
+            yield timestamp, direction, frame
+
+
+def replay(peer, path, speed=1.0):
+    """
+    Feeds incoming frames of capture at path to peer (PhotonPeer) through receive_incoming_commands and
+    dispatches them to its listener and handlers. speed 1.0 keeps recorded timing, 2.0 is twice as fast,
+    None as fast as possible. Ping results are skipped, round trip times of a replay would be meaningless.
+    Returns the number of frames replayed.
+    """
+    base_peer = peer.basePeer
+    count = 0
+    first = None
+    started = time.monotonic_ns()
+
+    for timestamp, direction, frame in read_capture(path):
+        if direction != INCOMING or frame[0] == PING_MAGIC:
+            continue
+
+        if speed is not None:
+            if first is None:
+                first = timestamp
+
+            delay = (timestamp - first) / speed - (time.monotonic_ns() - started)
+            if delay > 0:
+                time.sleep(delay / 1000000000)
+
+        base_peer.receive_incoming_commands(frame[PAYLOAD_OFFSET:])
+
+        while peer.dispatch_incoming_commands():
+            pass
+
+        count += 1
+
+    return count
+
+
+class CaptureReader:
+    """
+    Random access to a capture file through mmap. An index of every record's frame offset, timestamp,
+    direction, message type and op/event code is kept in a sidecar file (path + ".idx" by default),
+    built on first open and extended when the capture has grown since. Queries go over the index only,
+    frames are read (and decoded) just for the matching records.
+
+    Decoded messages may keep references to the mapped memory (lazy params, byte arrays), the reader must
+    stay open while they are used.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path if index_path is not None else path + ".idx"
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.view = memoryview(self.map)
+
+        if len(self.map) < _HEADER.size or _HEADER.unpack_from(self.map)[0] != _MAGIC:
+            self.close()
+            raise ValueError("{} is not a capture file".format(path))
+
+        version = _HEADER.unpack_from(self.map)[1]
+        if version != _VERSION:
+            self.close()
+            raise ValueError("Unsupported capture version {}".format(version))
+
+        for name, typecode in _INDEX_COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+        self.indexed_size = _HEADER.size
+
+        if not self.load_index():
+            for name, typecode in _INDEX_COLUMNS:
+                setattr(self, name, array.array(typecode))
+
+            self.indexed_size = _HEADER.size
+
+        if self.build_index():
+            self.save_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.view.release()
+                self.map.close()
+            except BufferError:
+                # frames or decoded messages still refer to it, the mapping goes away with them
+                pass
+
+            self.map = None
+
+    def build_index(self):
+        """
+        Indexes records after indexed_size, returns True if there were any. A record cut short ends the index.
+        """
+        view = self.view
+        size = len(view)
+        pos = self.indexed_size
+        added = False
+
+        while pos + _RECORD.size <= size:
+            direction, timestamp, length = _RECORD.unpack_from(view, pos)
+            offset = pos + _RECORD.size
+
+            if offset + length > size:
+                break
+
+            msg_type = PING
+            code = NO_CODE
+
+            if length >= HEADER_SIZE and view[offset] != PING_MAGIC:
+                msg_type = view[offset + HEADER_SIZE - 1] & 0x7F
+
+                if msg_type in (OPERATION_REQUEST, OPERATION_RESPONSE, EVENT) and length > HEADER_SIZE:
+                    code = view[offset + HEADER_SIZE]
+                    code = code - 256 if code > 127 else code
+
+            self.offsets.append(offset)
+            self.timestamps.append(timestamp)
+            self.directions.append(direction)
+            self.msg_types.append(msg_type)
+            self.codes.append(code)
+
+            pos = offset + length
+            added = True
+
+        self.indexed_size = pos
+
+        return added
+
+    def load_index(self):
+        """
+        Loads the sidecar index, returns False if there is none or it doesn't belong to this capture.
+        """
+        try:
+            f = open(self.index_path, "rb")
+        except OSError:
+            return False
+
+        with f:
+            header = f.read(_INDEX_HEADER.size)
+            if len(header) < _INDEX_HEADER.size:
+                return False
+
+            magic, version, little, indexed_size, count = _INDEX_HEADER.unpack(header)
+            if magic != _INDEX_MAGIC or version != _INDEX_VERSION or indexed_size > len(self.map):
+                return False
+
+            try:
+                for name, typecode in _INDEX_COLUMNS:
+                    column = getattr(self, name)
+                    column.fromfile(f, count)
+
+                    if little != (sys.byteorder == "little"):
+                        column.byteswap()
+            except EOFError:
+                return False
+
+        self.indexed_size = indexed_size
+
+        # the capture file may have been overwritten by another capture since
+        return count == 0 or (self.record_matches(0) and self.record_matches(count - 1))
+
+    def record_matches(self, i):
+        pos = self.offsets[i] - _RECORD.size
+        if pos < _HEADER.size or self.offsets[i] > self.indexed_size:
+            return False
+
+        direction, timestamp, length = _RECORD.unpack_from(self.view, pos)
+        return direction == self.directions[i] and timestamp == self.timestamps[i]
+
+    def save_index(self):
+        """
+        Writes the index to the sidecar file, silently skipped if it can't be written.
+        """
+        tmp_path = self.index_path + ".tmp"
+
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, sys.byteorder == "little",
+                                           self.indexed_size, len(self.offsets)))
+
+                for name, typecode in _INDEX_COLUMNS:
+                    getattr(self, name).tofile(f)
+
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    def find(self, msg_type=None, code=None, start=None, end=None, direction=None):
+        """
+        Returns numbers of records matching all given conditions: message type, op or event code (signed or
+        unsigned byte), time.monotonic_ns() timestamps start <= t < end and direction.
+        """
+        if code is not None and code > 127:
+            code -= 256
+
+        first = 0 if start is None else bisect.bisect_left(self.timestamps, start)
+        last = len(self.offsets) if end is None else bisect.bisect_left(self.timestamps, end)
+
+        found = []
+        msg_types = self.msg_types
+        codes = self.codes
+        directions = self.directions
+
+        for i in range(first, last):
+            if msg_type is not None and msg_types[i] != msg_type:
+                continue
+
+            if code is not None and codes[i] != code:
+                continue
+
+            if direction is not None and directions[i] != direction:
+                continue
+
+            found.append(i)
+
+        return found
+
+    def frame(self, i):
+        """
+        Returns the whole frame of record i as a view of the mapped file.
+        """
+        offset = self.offsets[i]
+        length = _RECORD.unpack_from(self.view, offset - _RECORD.size)[2]
+
+        return self.view[offset:offset + length]
+
+    def decode(self, i, numpy_arrays=False, lazy=False):
+        """
+        Deserializes record i straight from the mapped file: EventData, OperationResponse or
+        OperationRequest, None for other messages.
+        """
+        msg_type = self.msg_types[i]
+        if msg_type not in (OPERATION_REQUEST, OPERATION_RESPONSE, EVENT):
+            return None
+
+        body = self.frame(i)[HEADER_SIZE:]
+
+        if msg_type == EVENT:
+            return deserialize_event_data(body, numpy_arrays, lazy)
+        elif msg_type == OPERATION_RESPONSE:
+            return deserialize_op_response(body, numpy_arrays)
+        else:
+            return deserialize_op_request(body, numpy_arrays)
+
+    def events(self, code=None, start=None, end=None, numpy_arrays=False, lazy=False):
+        """
+        Yields (timestamp, EventData) of received events, optionally of one code and time range, see find.
+        """
+        for i in self.find(EVENT, code, start, end, INCOMING):
+            yield self.timestamps[i], self.decode(i, numpy_arrays, lazy)
@@ -0,0 +1,218 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import time
+
+# bytes a channel of weight 1 may send per scheduling round
+QUANTUM = 1024
+
+
+class OutgoingChannel:
+    """
+    Queue of serialized messages of one channel waiting to be sent.
+    """
+    __slots__ = ("messages", "enqueued", "bytes", "priority", "weight", "max_bytes_per_flush", "rate_limit",
+                 "deficit", "sent_count", "coalesced")
+
+    def __init__(self, priority=0, weight=1, max_bytes_per_flush=None, rate_limit=None):
+        self.messages = collections.deque()
+        # time.perf_counter_ns() of enqueueing, parallel to messages
+        self.enqueued = collections.deque()
+        self.bytes = 0
+
+        self.priority = priority
+        self.weight = weight
+        self.max_bytes_per_flush = max_bytes_per_flush
+        self.rate_limit = rate_limit
+
+        self.deficit = 0
+
+        # coalesce key -> sequence number of the message (sent_count + its index in messages)
+        self.sent_count = 0
+        self.coalesced = {}
+
+    def append(self, message, coalesce_key=None):
+        if coalesce_key is not None:
+            self.coalesced[coalesce_key] = self.sent_count + len(self.messages)
+
+        self.messages.append(message)
+        self.enqueued.append(time.perf_counter_ns())
+        self.bytes += len(message)
+
+    def replace(self, coalesce_key, message):
+        """
+        Puts message in place of the queued one with coalesce_key and returns the replaced one,
+        None if there is no such message.
+        """
+        seq = self.coalesced.get(coalesce_key)
+        if seq is None:
+            return None
+
+        if seq < self.sent_count:
+            # already sent
+            del self.coalesced[coalesce_key]
+            return None
+
+        replaced = self.messages[seq - self.sent_count]
+        self.messages[seq - self.sent_count] = message
+        self.bytes += len(message) - len(replaced)
+
+        return replaced
+
+    def popleft(self):
+        """
+        Returns the first message and time.perf_counter_ns() of when it was enqueued.
+        """
+        message = self.messages.popleft()
+        enqueued = self.enqueued.popleft()
+        self.bytes -= len(message)
+        self.sent_count += 1
+
+        if not self.messages:
+            self.coalesced.clear()
+            self.deficit = 0
+
+        return message, enqueued
+
+    def drop_unreliable(self):
+        """
+        Removes unreliable messages and returns them.
+        """
+        dropped = [message for message in self.messages if not message[6]]
+
+        if dropped:
+            kept = [(message, enqueued) for message, enqueued in zip(self.messages, self.enqueued) if message[6]]
+            self.messages = collections.deque(message for message, enqueued in kept)
+            self.enqueued = collections.deque(enqueued for message, enqueued in kept)
+            self.bytes = sum(len(message) for message in self.messages)
+            # only unreliable messages are coalesced
+            self.coalesced.clear()
+
+        return dropped
+
+    def clear(self):
+        self.messages = collections.deque()
+        self.enqueued = collections.deque()
+        self.bytes = 0
+        self.deficit = 0
+        self.coalesced.clear()
+
+
+def schedule(channels, max_bytes=None, rate_limit=None, stats=None, enqueued=None):
+    """
+    Takes messages for one flush out of channels and returns them in sending order, the rest stays queued.
+
+    Channels of higher priority go first. Channels of equal priority share by deficit round robin: per round
+    a channel may send weight * QUANTUM bytes, so their messages are interleaved in proportion to weights.
+    A channel sends at most its max_bytes_per_flush and all of them together at most max_bytes (None is
+    no limit), but the first message of a channel or a flush goes even if it alone exceeds the limit.
+    Messages leave only while rate_limit (for all channels) and channel's own rate_limit allow.
+    Time sent messages spent in queue is counted in stats (SendStats), their enqueueing times are appended
+    to enqueued list if it is given.
+    """
+    batch = []
+    budget = max_bytes
+    now = time.monotonic()
+    now_ns = time.perf_counter_ns()
+
+    for priority in sorted({channel.priority for channel in channels if channel.messages}, reverse=True):
+        active = [channel for channel in channels if channel.priority == priority and channel.messages]
+        flushed = dict.fromkeys(map(id, active), 0)
+
+        while active:
+            next_round = []
+
+            for channel in active:
+                channel.deficit += channel.weight * QUANTUM
+                limit = channel.max_bytes_per_flush
+                capped = False
+
+                while channel.messages:
+                    size = len(channel.messages[0])
+
+                    if size > channel.deficit:
+                        break
+
+                    if limit is not None and flushed[id(channel)] and flushed[id(channel)] + size > limit:
+                        capped = True
+                        break
+
+                    if budget is not None and batch and size > budget:
+                        return batch
+
+                    if rate_limit is not None and rate_limit.delay(size, now):
+                        return batch
+
+                    if channel.rate_limit is not None:
+                        if channel.rate_limit.delay(size, now):
+                            capped = True
+                            break
+
+                        channel.rate_limit.take(size, now)
+
+                    if rate_limit is not None:
+                        rate_limit.take(size, now)
+
+                    channel.deficit -= size
+                    message, enqueued_ns = channel.popleft()
+                    batch.append(message)
+                    flushed[id(channel)] += size
+
+                    if budget is not None:
+                        budget -= size
+
+                    if stats is not None:
+                        stats.count_wait((now_ns - enqueued_ns) / 1000000000)
+
+                    if enqueued is not None:
+                        enqueued.append(enqueued_ns)
+
+                if capped:
+                    channel.deficit = 0
+                elif channel.messages:
+                    next_round.append(channel)
+
+            active = next_round
+
+    return batch
+
+
+def send_delay(channels, rate_limit=None):
+    """
+    Returns seconds until rate limits let the first message of some channel go, 0 if one can go now,
+    None if all channels are empty.
+    """
+    delay = None
+    now = time.monotonic()
+
+    for channel in channels:
+        if not channel.messages:
+            continue
+
+        size = len(channel.messages[0])
+        channel_delay = 0
+
+        if rate_limit is not None:
+            channel_delay = rate_limit.delay(size, now)
+
+        if channel.rate_limit is not None:
+            channel_delay = max(channel_delay, channel.rate_limit.delay(size, now))
+
+        if delay is None or channel_delay < delay:
+            delay = channel_delay
+
+    return delay
@@ -62,4 +62,23 @@ class StatusCode(IntEnum):
     TcpRouterResponseEndpointUnknown = 1046
     TcpRouterResponseNodeNotReady = 1047
     EncryptionEstablished = 1048
-    EncryptionFailedToEstablish = 1049
\ No newline at end of file
+    EncryptionFailedToEstablish = 1049
+
+
+class TraceStage(IntEnum):
+    """
+    Stages of message processing reported to trace hooks (see photon.tracing).
+    """
+    Enqueue = 0
+    Serialize = 1
+    QueueWait = 2
+    Send = 3
+    Receive = 4
+    FrameComplete = 5
+    IncomingWait = 6
+    Decode = 7
+    Callback = 8
+    Dispatch = 9
+    SendLockWait = 10
+    DispatchLockWait = 11
+    IncomingLockWait = 12
@@ -0,0 +1,82 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+HEADER_SIZE = 9
+PING_MAGIC = 256 - 16
+
+# payload handed to TPeer starts with the last two header bytes (0xF3 and message type)
+PAYLOAD_OFFSET = 7
+
+
+def read_frame_length(header, offset=0):
+    """
+    Returns total length (header included) of the frame which header starts at offset.
+    Ping results are always HEADER_SIZE long.
+    """
+    if header[offset] == PING_MAGIC:
+        return HEADER_SIZE
+
+    return header[offset + 1] << 24 | header[offset + 2] << 16 | header[offset + 3] << 8 | header[offset + 4]
+
+
+def split_frames(view, start, end, deliver, capture=None):
+    """
+    Passes every complete frame in view[start:end] to deliver (as a copy, in the form
+    TPeer.receive_incoming_commands expects) and returns offset of the first incomplete one.
+    Whole frames are also passed to capture if it is given, as views valid only during the call.
+    """
+    while end - start >= HEADER_SIZE:
+        length = read_frame_length(view, start)
+        if length < HEADER_SIZE:
+            raise ValueError("Invalid frame length {}".format(length))
+
+        if end - start < length:
+            break
+
+        if capture is not None:
+            capture(view[start:start + length])
+
+        if view[start] == PING_MAGIC:
+            deliver(bytes(view[start:start + length]))
+        else:
+            deliver(bytes(view[start + PAYLOAD_OFFSET:start + length]))
+
+        start += length
+
+    return start
+
+
+class FrameParser:
+    """
+    Splits TCP stream into messages for TPeer.receive_incoming_commands: whole ping results and,
+    for other frames, payload starting at PAYLOAD_OFFSET.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data, capture=None):
+        buf = self.buffer
+        buf += data
+
+        messages = []
+        with memoryview(buf) as view:
+            pos = split_frames(view, 0, len(buf), messages.append, capture)
+
+        if pos:
+            del buf[:pos]
+
+        return messages
@@ -0,0 +1,98 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+from photon.enums import DebugLevel
+
+_LOGGING_LEVELS = {
+    DebugLevel.Error: logging.ERROR,
+    DebugLevel.Warning: logging.WARNING,
+    DebugLevel.Info: logging.INFO,
+    DebugLevel.All: logging.DEBUG,
+}
+
+
+class LogRecord:
+    """
+    Debug message of a peer. message is a str.format() template, it is filled with args only when a sink
+    writes it out, fields are structured data of the record (op_code, size...). deferred is True for records
+    of threads other than the one dispatching (the connection thread).
+    """
+    __slots__ = ("peer_id", "level", "message", "args", "fields", "deferred")
+
+    def __init__(self, peer_id, level, message, args=(), fields=None, deferred=False):
+        self.peer_id = peer_id
+        self.level = level
+        self.message = message
+        self.args = args
+        self.fields = fields if fields is not None else {}
+        self.deferred = deferred
+
+    def get_message(self):
+        if not self.args:
+            return str(self.message)
+
+        return self.message.format(*self.args)
+
+    def __str__(self):
+        return self.get_message()
+
+
+class LogSink:
+    """
+    Receives debug records of peers, see PhotonPeer.set_log_sink. emit is called on the thread that logs,
+    so it must be thread safe.
+    """
+
+    def emit(self, record):
+        pass
+
+
+class ListenerSink(LogSink):
+    """
+    Passes records to PeerListener.debug_return of peer. Deferred records are queued and passed when the peer
+    dispatches, so the listener is always called from the dispatching thread. This is the default sink.
+    """
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def emit(self, record):
+        if record.deferred:
+            self.peer.enqueue_action_for_dispatch(lambda: self.debug_return(record))
+        else:
+            self.debug_return(record)
+
+    def debug_return(self, record):
+        # a record without args goes as it is, it may be an exception
+        message = record.get_message() if record.args else record.message
+        self.peer.peer_listener.debug_return(record.level, message)
+
+
+class LoggingSink(LogSink):
+    """
+    Writes records to a logging.Logger (by default "photon") right away on the thread that logs. peer_id and
+    fields are set on logging records as attributes peer_id and photon.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger if logger is not None else logging.getLogger("photon")
+
+    def emit(self, record):
+        level = _LOGGING_LEVELS.get(record.level, logging.DEBUG)
+
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, record.get_message(), extra={"peer_id": record.peer_id, "photon": record.fields})
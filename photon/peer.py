@@ -16,17 +16,40 @@ limitations under the License.
 
 import threading
 from photon import tpeer
-from photon.enums import ConnectionProtocol
+from photon.capture import CaptureWriter
+from photon.enums import ConnectionProtocol, TraceStage
+from photon.ratelimit import RateLimit
+from photon.stats import DispatchCounter, LatencyHistogram, ResponseTimer, TrafficStats
+from photon.utils import signed_byte
 
 
 class PhotonPeer:
-    def __init__(self, protocol, peer_listener=None):
+    def __init__(self, protocol, peer_listener=None, reactor=None):
+        """
+        With reactor (photon.reactor.Reactor) the connection is served by the reactor's shared I/O thread
+        instead of a thread of its own.
+        """
         self.send_lock = threading.Lock()
         self.dispatch_lock = threading.Lock()
         self.enqueue_lock = threading.Lock()
+        # handler dicts and ignored sets are replaced, never changed in place, so dispatching reads them
+        # without a lock and handlers can be registered from callbacks
+        self.handlers_lock = threading.Lock()
+
+        self.max_dispatch_per_service = None
+
+        self._service_condition = threading.Condition()
+        self._service_pending = False
+        self._service_running = False
+        self._service_thread = None
+        # marks threads running callbacks (see dispatch_incoming_*), blocking there would wait for themselves
+        self._dispatching = threading.local()
 
         if protocol == ConnectionProtocol.Tcp:
             self.basePeer = tpeer.TPeer(peer_listener)
+
+            if reactor is not None:
+                self.basePeer.connection_factory = reactor.create_connection
         else:
             raise Exception("Support only TCP protocol")
 
@@ -51,20 +74,371 @@ class PhotonPeer:
     def set_debug_level(self, debug_level):
         self.basePeer.debug_level = debug_level
 
+    def set_log_sink(self, sink):
+        """
+        Where debug messages of debug_level go, a LogSink (photon.logs). By default they go to
+        PeerListener.debug_return, LoggingSink writes them to logging without waiting for dispatch.
+        """
+        self.basePeer.log_sink = sink
+
+    def set_receive_buffer_size(self, size):
+        """
+        Size of the chunks connection reads from socket. The buffer grows if a message doesn't fit in it.
+        Takes effect on next connect.
+        """
+        self.basePeer.receive_buffer_size = size
+
+    def set_numpy_arrays(self, enabled):
+        """
+        Numeric arrays in incoming messages will be decoded into numpy arrays instead of array.array.
+        Has no effect if numpy is not installed.
+        """
+        self.basePeer.numpy_arrays = enabled
+
+    def set_lazy_event_params(self, enabled):
+        """
+        Event parameters will be decoded only when accessed. EventData.params becomes a read-only mapping.
+        """
+        self.basePeer.lazy_event_params = enabled
+
+    def register_event_handler(self, code, handler):
+        """
+        Events with this code go to handler(event_data) instead of listener's on_event.
+        Codes may be given as unsigned (255) or signed (-1) bytes, see utils.signed_byte.
+        """
+        with self.handlers_lock:
+            handlers = dict(self.basePeer.event_handlers)
+            handlers[signed_byte(code)] = handler
+            self.basePeer.event_handlers = handlers
+
+    def unregister_event_handler(self, code):
+        with self.handlers_lock:
+            handlers = dict(self.basePeer.event_handlers)
+            handlers.pop(signed_byte(code), None)
+            self.basePeer.event_handlers = handlers
+
+    def register_response_handler(self, op_code, handler):
+        """
+        Responses to this operation go to handler(op_response) instead of listener's on_operation_response.
+        """
+        with self.handlers_lock:
+            handlers = dict(self.basePeer.response_handlers)
+            handlers[signed_byte(op_code)] = handler
+            self.basePeer.response_handlers = handlers
+
+    def unregister_response_handler(self, op_code):
+        with self.handlers_lock:
+            handlers = dict(self.basePeer.response_handlers)
+            handlers.pop(signed_byte(op_code), None)
+            self.basePeer.response_handlers = handlers
+
+    def set_ignored_events(self, codes):
+        """
+        Events with these codes are dropped before their parameters are decoded.
+        """
+        self.basePeer.ignored_event_codes = {signed_byte(code) for code in codes}
+
+    def set_ignored_responses(self, op_codes):
+        self.basePeer.ignored_op_codes = {signed_byte(op_code) for op_code in op_codes}
+
+    def set_drop_unhandled(self, enabled):
+        """
+        Events and responses without a registered handler are dropped instead of going to the listener.
+        """
+        self.basePeer.drop_unhandled = enabled
+
+    def get_event_counters(self):
+        """
+        Returns dict code -> DispatchCounter of delivered and dropped events, codes are signed as in EventData.code.
+        """
+        counters = dict(self.basePeer.event_counters)
+        return {code: DispatchCounter(c.delivered, c.dropped) for code, c in counters.items()}
+
+    def get_response_counters(self):
+        counters = dict(self.basePeer.response_counters)
+        return {code: DispatchCounter(c.delivered, c.dropped) for code, c in counters.items()}
+
+    def set_outgoing_queue_limits(self, max_messages=None, max_bytes=None, high_watermark=0.8, low_watermark=0.5,
+                                  drop_unreliable_first=False):
+        """
+        Bounds queue of operations waiting to be sent, None means no limit. When it fills up to high_watermark
+        (fraction of a limit) QueueOutgoingReliableWarning or QueueOutgoingUnreliableWarning is reported, again only
+        after it went below low_watermark. Rejected reliable ops are reported with QueueOutgoingReliableError.
+        With drop_unreliable_first unreliable ops are dropped to make room for reliable ones and never wait.
+        """
+        with self.basePeer.outgoing_lock:
+            self.basePeer.outgoing_max_messages = max_messages
+            self.basePeer.outgoing_max_bytes = max_bytes
+            self.basePeer.outgoing_high_watermark = high_watermark
+            self.basePeer.outgoing_low_watermark = low_watermark
+            self.basePeer.outgoing_drop_unreliable = drop_unreliable_first
+            self.basePeer.outgoing_space.notify_all()
+
+    def set_channel_count(self, count):
+        """
+        Number of channels op_custom accepts, channel_id goes from 0 to count - 1.
+        """
+        if count < 1:
+            raise ValueError("Channel count must be positive, got {}".format(count))
+
+        self.basePeer.m_channelCount = count
+
+    def set_channel(self, channel_id, priority=0, weight=1, max_bytes_per_flush=None):
+        """
+        Configures how queued ops of a channel are scheduled. Channels of higher priority are sent first,
+        channels of equal priority share each flush in proportion to their weights. max_bytes_per_flush
+        bounds what a channel sends per flush, the rest waits for the next one (None is no limit).
+        """
+        if not 0 <= channel_id < self.basePeer.m_channelCount:
+            raise ValueError("Channel {} is out of range, channel count is {}".format(
+                channel_id, self.basePeer.m_channelCount))
+
+        if weight <= 0:
+            raise ValueError("Channel weight must be positive, got {}".format(weight))
+
+        with self.basePeer.outgoing_lock:
+            channel = self.basePeer.outgoing_channel(channel_id)
+            channel.priority = priority
+            channel.weight = weight
+            channel.max_bytes_per_flush = max_bytes_per_flush
+
+    def set_max_bytes_per_flush(self, max_bytes):
+        """
+        Bounds bytes of all channels sent per flush, None is no limit.
+        """
+        with self.basePeer.outgoing_lock:
+            self.basePeer.outgoing_max_bytes_per_flush = max_bytes
+
+    def set_rate_limit(self, messages_per_second=None, bytes_per_second=None, channel_id=None,
+                       burst_messages=None, burst_bytes=None):
+        """
+        Paces sending of queued ops with token buckets, for all channels together or, with channel_id, for one
+        channel. Ops over the rate wait in the queue (where limits of set_outgoing_queue_limits apply) and the
+        service loop wakes up when they may go. Without rates the limit is removed. See ratelimit.RateLimit.
+        """
+        if messages_per_second is None and bytes_per_second is None:
+            rate_limit = None
+        else:
+            rate_limit = RateLimit(messages_per_second, bytes_per_second, burst_messages, burst_bytes)
+
+        with self.basePeer.outgoing_lock:
+            if channel_id is None:
+                self.basePeer.outgoing_rate_limit = rate_limit
+            else:
+                if not 0 <= channel_id < self.basePeer.m_channelCount:
+                    raise ValueError("Channel {} is out of range, channel count is {}".format(
+                        channel_id, self.basePeer.m_channelCount))
+
+                self.basePeer.outgoing_channel(channel_id).rate_limit = rate_limit
+
+        self.wake()
+
+    def add_trace_hook(self, hook):
+        """
+        Registers hook (photon.tracing.TraceHook) to get perf_counter_ns() timings of every processing stage
+        of sent and received messages. Without hooks tracing costs one check per stage.
+        """
+        with self.dispatch_lock:
+            with self.send_lock:
+                self.basePeer.trace_hooks = self.basePeer.trace_hooks + (hook,)
+
+    def remove_trace_hook(self, hook):
+        with self.dispatch_lock:
+            with self.send_lock:
+                self.basePeer.trace_hooks = tuple(h for h in self.basePeer.trace_hooks if h is not hook)
+
+    def set_traffic_stats_enabled(self, enabled):
+        """
+        Starts or stops counting incoming and outgoing traffic, see get_traffic_stats().
+        """
+        self.basePeer.traffic_stats_enabled = enabled
+
+    def get_traffic_stats(self):
+        """
+        Returns snapshot (incoming, outgoing) of TrafficStats: bytes and counts of commands, pings,
+        operations by op code and events by event code. Counting is off by default, see set_traffic_stats_enabled.
+        """
+        return self.basePeer.traffic_stats_incoming.copy(), self.basePeer.traffic_stats_outgoing.copy()
+
+    def reset_traffic_stats(self):
+        self.basePeer.traffic_stats_incoming = TrafficStats()
+        self.basePeer.traffic_stats_outgoing = TrafficStats()
+
+    def set_response_times_enabled(self, enabled):
+        """
+        Starts or stops measuring time from sending an operation to receiving its response, see get_response_times().
+        """
+        self.basePeer.response_times_enabled = enabled
+
+    def get_rtt_histogram(self):
+        """
+        Returns LatencyHistogram of measured round trip times (ms), always collected.
+        """
+        return self.basePeer.rtt_histogram.copy()
+
+    def get_response_times(self):
+        """
+        Returns dict op code -> LatencyHistogram of response times (ms). Responses are matched to requests
+        by op code in sending order, so ops that don't always get a response make it approximate.
+        """
+        # connection thread may add op codes meanwhile
+        histograms = dict(self.basePeer.response_timer.histograms)
+        return {op_code: histogram.copy() for op_code, histogram in histograms.items()}
+
+    def reset_latency_stats(self):
+        self.basePeer.rtt_histogram = LatencyHistogram()
+        self.basePeer.response_timer = ResponseTimer()
+
+    def start_capture(self, path):
+        """
+        Starts writing every sent and received frame with its time to capture file at path, see photon.capture
+        for reading and replaying it. A running capture is closed first.
+        """
+        self.stop_capture()
+        self.basePeer.capture = CaptureWriter(path, self.basePeer)
+
+    def stop_capture(self):
+        capture = self.basePeer.capture
+        self.basePeer.capture = None
+
+        if capture is not None:
+            capture.close()
+
+    def get_send_stats(self):
+        """
+        Returns SendStats: totals and the last flush's numbers of messages, bytes and send syscalls,
+        and how long sent ops waited in queue.
+        """
+        with self.send_lock:
+            return self.basePeer.send_stats.copy()
+
+    def set_max_dispatch_per_service(self, max_count):
+        """
+        Limits number of incoming messages service() dispatches per call, None means all pending.
+        """
+        self.max_dispatch_per_service = max_count
+
     def service(self):
-        while self.dispatch_incoming_commands():
-            pass
+        self.dispatch_incoming_batch(self.max_dispatch_per_service)
 
         self.send_outgoing_commands()
 
+    def service_forever(self):
+        """
+        Calls service() whenever there is work: an incoming message, a queued operation or callback, or a due ping.
+        Sleeps otherwise. Blocks until stop_service() is called.
+        """
+        self._service_running = True
+        self._service_loop()
+
+    def _service_loop(self):
+        self._service_pending = True
+        self.basePeer.wakeup = self.wake
+
+        try:
+            while self._service_running:
+                with self._service_condition:
+                    if not self._service_pending:
+                        self._service_condition.wait(self.basePeer.get_service_timeout())
+
+                    self._service_pending = False
+
+                if self._service_running:
+                    self.service()
+
+                    if self.basePeer.incoming_list:
+                        # max_dispatch_per_service left some, go on right away
+                        self.wake()
+        finally:
+            self.basePeer.wakeup = None
+
+    def start_service(self):
+        """
+        Runs service_forever() in a background thread.
+        """
+        if self._service_thread is not None:
+            return
+
+        self._service_running = True
+        self._service_thread = threading.Thread(target=self._service_loop, name="PhotonPeerService", daemon=True)
+        self._service_thread.start()
+
+    def stop_service(self):
+        self._service_running = False
+        self.wake()
+
+        if self._service_thread is not None:
+            if self._service_thread is not threading.current_thread():
+                self._service_thread.join()
+
+            self._service_thread = None
+
+    def wake(self):
+        if not self._service_pending:
+            with self._service_condition:
+                self._service_pending = True
+                self._service_condition.notify()
+
     def send_outgoing_commands(self):
-        with self.send_lock:
+        with self.basePeer.locked(self.send_lock, TraceStage.SendLockWait):
             return self.basePeer.send_outgoing_commands()
 
     def dispatch_incoming_commands(self):
-        with self.dispatch_lock:
-            return self.basePeer.dispatch_incoming_commands()
+        with self.basePeer.locked(self.dispatch_lock, TraceStage.DispatchLockWait):
+            self._dispatching.active = True
+            try:
+                return self.basePeer.dispatch_incoming_commands()
+            finally:
+                self._dispatching.active = False
+
+    def dispatch_incoming_batch(self, max_count=None):
+        with self.basePeer.locked(self.dispatch_lock, TraceStage.DispatchLockWait):
+            self._dispatching.active = True
+            try:
+                return self.basePeer.dispatch_incoming_batch(max_count)
+            finally:
+                self._dispatching.active = False
+
+    def op_custom(self, op_code, params, reliable, channel_id=0, reuse_buffer=False, block=False, timeout=None,
+                  coalesce_key=None):
+        """
+        With reuse_buffer the message is serialized into a pooled buffer which is returned to the pool after sending.
+
+        If outgoing queue is full (see set_outgoing_queue_limits) the op is rejected and False returned, unless
+        block is set: then it waits up to timeout seconds (forever if None) for the queue to be flushed.
+        Called from a callback (the thread dispatching, however service() is run) op_custom never blocks.
+
+        An unreliable op with coalesce_key (any hashable, e.g. object id) replaces a not yet sent op with the same
+        op_code, channel and key, so after a stall only the latest state goes out. Reliable ops are never coalesced.
+        """
+        block = block and not getattr(self._dispatching, "active", False)
+
+        if block:
+            # waiting must not hold up other senders, queue changes are serialized by outgoing_lock anyway
+            return self.basePeer.enqueue_operation(op_code, params, reliable, channel_id, False,
+                                                   reuse_buffer=reuse_buffer, block=block, timeout=timeout,
+                                                   coalesce_key=coalesce_key)
+
+        with self.enqueue_lock:
+            return self.basePeer.enqueue_operation(op_code, params, reliable, channel_id, False,
+                                                   reuse_buffer=reuse_buffer, block=block, timeout=timeout,
+                                                   coalesce_key=coalesce_key)
+
+    def create_template(self, op_code, params, fields):
+        """
+        Serializes operation once, values of fields (fixed width parameters) can be changed later with
+        template.set(key, value) and the operation sent with op_template().
+        """
+        return self.basePeer.create_operation_template(op_code, params, fields)
+
+    def op_template(self, template, reliable, channel_id=0, reuse_buffer=False, block=False, timeout=None,
+                    coalesce_key=None):
+        block = block and not getattr(self._dispatching, "active", False)
+
+        if block:
+            return self.basePeer.enqueue_template(template, reliable, channel_id, reuse_buffer, block, timeout,
+                                                  coalesce_key)
 
-    def op_custom(self, op_code, params, reliable, channel_id=0):
         with self.enqueue_lock:
-            return self.basePeer.enqueue_operation(op_code, params, reliable, channel_id, False)
+            return self.basePeer.enqueue_template(template, reliable, channel_id, reuse_buffer, block, timeout,
+                                                  coalesce_key)
@@ -14,47 +14,315 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import traceback
-import struct
 import array
+import collections.abc
+import struct
+import sys
 from photon.operations import OperationRequest, OperationResponse, EventData
 from photon.typeddict import typed_dict
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_BYTE = struct.Struct('>b')
+_SHORT = struct.Struct('>h')
+_INTEGER = struct.Struct('>i')
+_LONG = struct.Struct('>q')
+_FLOAT = struct.Struct('>f')
+_DOUBLE = struct.Struct('>d')
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
 
 def serialize_op_request(op_request):
-    out = bytearray()
+    out = bytearray(calc_size(op_request, False))
 
-    _serialize_op_request(out, op_request, False)
+    _serialize_op_request(ByteWriter(out), op_request, False)
 
     return out
 
 
-def deserialize_event_data(buf):
+def serialize_into(buffer, offset, op_request):
+    """
+    Serializes operation request into a writable buffer (bytearray, memoryview) starting at offset.
+    Returns offset right after the written data.
+    """
+    end = offset + calc_size(op_request, False)
+    if end > len(buffer):
+        raise ValueError("Buffer too small: need {} bytes at offset {}, have {}"
+                         .format(end - offset, offset, len(buffer) - offset))
+
+    _serialize_op_request(ByteWriter(buffer, offset), op_request, False)
+
+    return end
+
+
+def calc_size(value, set_type=True):
+    """
+    Returns number of bytes value takes when serialized (with its type code if set_type is True).
+    Top level operation requests are serialized without type code, so use calc_size(op_request, False) for them.
+    """
+    if value is None:
+        return 1
+
+    func = _SIZES.get(type(value))
+    if func is None:
+        func = _find_in_table(_SIZES, type(value))
+
+    return func(value, set_type)
+
+
+def deserialize_event_data(buf, numpy_arrays=False, lazy=False):
+    """
+    With lazy set params is a LazyParams mapping which keeps a reference to buf and decodes values on access.
+    """
+    reader = ByteReader.of(buf, numpy_arrays)
+
     result = EventData()
-    result.code = _deserialize_byte(buf)
-    result.params = _deserialize_parameters(buf)
+    result.code = _deserialize_byte(reader)
+    result.params = LazyParams(reader) if lazy else _deserialize_parameters(reader)
 
     return result
 
 
-def deserialize_op_request(buf):
+def deserialize_op_request(buf, numpy_arrays=False):
+    reader = ByteReader.of(buf, numpy_arrays)
+
     result = OperationRequest()
-    result.op_code = _deserialize_byte(buf)
-    result.params = _deserialize_parameters(buf)
+    result.op_code = _deserialize_byte(reader)
+    result.params = _deserialize_parameters(reader)
 
     return result
 
 
-def deserialize_op_response(buf):
+def deserialize_op_response(buf, numpy_arrays=False):
+    reader = ByteReader.of(buf, numpy_arrays)
+
     result = OperationResponse()
-    result.op_code = _deserialize_byte(buf)
-    result.return_code = _deserialize_short(buf)
-    result.debug_message = _deserialize(buf)
-    result.params = _deserialize_parameters(buf)
+    result.op_code = _deserialize_byte(reader)
+    result.return_code = _deserialize_short(reader)
+    result.debug_message = _deserialize(reader)
+    result.params = _deserialize_parameters(reader)
 
     return result
 
 
+class ByteReader:
+    """
+    Cursor over a bytes-like object. Reads advance an offset into a memoryview
+    instead of consuming the underlying buffer, so decoding never copies or
+    shifts the remaining data.
+
+    With numpy_arrays set numeric arrays are decoded into numpy arrays (if numpy is installed).
+    """
+
+    __slots__ = ("view", "pos", "numpy_arrays")
+
+    def __init__(self, buf, pos=0, numpy_arrays=False):
+        self.view = buf if isinstance(buf, memoryview) else memoryview(buf)
+        self.pos = pos
+        self.numpy_arrays = numpy_arrays and numpy is not None
+
+    @staticmethod
+    def of(buf, numpy_arrays=False):
+        if isinstance(buf, ByteReader):
+            return buf
+
+        return ByteReader(buf, numpy_arrays=numpy_arrays)
+
+    def remaining(self):
+        return len(self.view) - self.pos
+
+    def unpack(self, fmt):
+        pos = self.pos
+        end = pos + fmt.size
+        if end > len(self.view):
+            raise ValueError("Unexpected end of buffer: need {} bytes at {}, have {}"
+                             .format(fmt.size, pos, len(self.view) - pos))
+
+        self.pos = end
+        return fmt.unpack_from(self.view, pos)[0]
+
+    def read(self, count):
+        pos = self.pos
+        end = pos + count
+        if count < 0 or end > len(self.view):
+            raise ValueError("Unexpected end of buffer: need {} bytes at {}, have {}"
+                             .format(count, pos, len(self.view) - pos))
+
+        self.pos = end
+        return self.view[pos:end]
+
+    def skip(self, count):
+        end = self.pos + count
+        if count < 0 or end > len(self.view):
+            raise ValueError("Unexpected end of buffer: need {} bytes at {}, have {}"
+                             .format(count, self.pos, len(self.view) - self.pos))
+
+        self.pos = end
+
+
+class ByteWriter:
+    """
+    Cursor over a preallocated writable buffer, counterpart of ByteReader.
+    append() and extend() behave like the bytearray ones so serializers don't care where they write.
+    """
+
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+
+    def append(self, value):
+        self.buf[self.pos] = value
+        self.pos += 1
+
+    def extend(self, data):
+        if type(data) is not bytes and type(data) is not bytearray:
+            try:
+                data = memoryview(data).cast('B')
+            except TypeError:
+                data = bytes(data)
+
+        end = self.pos + len(data)
+        self.buf[self.pos:end] = data
+        self.pos = end
+
+    def pack(self, fmt, value):
+        fmt.pack_into(self.buf, self.pos, value)
+        self.pos += fmt.size
+
+
+class _ByteCounter:
+    __slots__ = ("pos",)
+
+    def __init__(self):
+        self.pos = 0
+
+    def append(self, value):
+        self.pos += 1
+
+    def extend(self, data):
+        try:
+            self.pos += memoryview(data).nbytes
+        except TypeError:
+            self.pos += len(bytes(data))
+
+    def pack(self, fmt, value):
+        self.pos += fmt.size
+
+
+class OperationTemplate:
+    """
+    Operation request serialized once, optionally behind a message head.
+
+    Parameters listed in fields are fixed width (boolean, byte, short, integer, long, float, double) and can be
+    patched in place with set() without serializing the request again. fields is either an iterable of keys,
+    in which case the type code follows from the current value (ints get at least integer width, so counters
+    starting at 0 have room to grow), or a mapping key -> type code to force width.
+    """
+
+    def __init__(self, op_request, fields, head=b""):
+        codes = dict(fields) if isinstance(fields, dict) else dict.fromkeys(fields)
+        params = op_request.params if op_request.params is not None else {}
+
+        for key in codes:
+            if key not in params:
+                raise KeyError("Template field {} is not a parameter of {}".format(key, op_request))
+
+            if codes[key] is None:
+                if type(params[key]) is int:
+                    codes[key] = 108 if _int_size(params[key]) == 8 else 105
+                else:
+                    codes[key] = _get_code_for_value(params[key])
+
+            if codes[key] not in _FIXED_STRUCTS:
+                raise ValueError("Template field {} must be of fixed width type, got code {}".format(key, codes[key]))
+
+        size = 1 + _size_parameters(params)
+        for key in codes:
+            size += _CODE_SIZES[codes[key]](params[key], False) - calc_size(params[key], False)
+
+        self.buffer = bytearray(len(head) + size)
+        self.offsets = {}
+
+        out = ByteWriter(self.buffer)
+        out.extend(head)
+        out.append(op_request.op_code)
+        _serialize_short(out, len(params), False)
+
+        for key in params:
+            _serialize_byte(out, key, False)
+
+            code = codes.get(key)
+            if code is None:
+                _serialize(out, params[key], True)
+            else:
+                out.append(code)
+                self.offsets[key] = (out.pos, _FIXED_STRUCTS[code])
+                _CODE_SERIALIZERS[code](out, params[key], False)
+
+    def set(self, key, value):
+        offset, fmt = self.offsets[key]
+
+        try:
+            fmt.pack_into(self.buffer, offset, value)
+        except struct.error as e:
+            raise ValueError("Value {} doesn't fit template field {} of {} bytes: {}".format(value, key, fmt.size, e))
+
+    def build(self):
+        return bytearray(self.buffer)
+
+
+class LazyParams(collections.abc.Mapping):
+    """
+    Read-only parameters mapping backed by the serialized message.
+
+    Construction walks the parameters once, skipping over values to record where each one starts.
+    A value is decoded on first access and cached.
+    """
+
+    __slots__ = ("_view", "_numpy_arrays", "_offsets", "_values")
+
+    def __init__(self, reader):
+        self._view = reader.view
+        self._numpy_arrays = reader.numpy_arrays
+        self._offsets = {}
+        self._values = {}
+
+        length = _deserialize_short(reader)
+        for i in range(length):
+            key = _deserialize_byte(reader)
+            self._offsets[key] = reader.pos
+            _skip(reader)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        reader = ByteReader(self._view, self._offsets[key], self._numpy_arrays)
+        value = self._values[key] = _deserialize(reader)
+
+        return value
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 # private methods
 
 
@@ -63,124 +331,128 @@ def _serialize(out, value, set_type):
         out.append(42)
         return
 
-    v_type = type(value)
-
-    if str == v_type:
-        _serialize_string(out, value, set_type)
-    elif bool == v_type:
-        _serialize_boolean(out, value, set_type)
-    elif int == v_type:
-        byte_cnt = (value.bit_length() + 7) // 8
-
-        if byte_cnt == 1:
-            _serialize_byte(out, value, set_type)
-        elif byte_cnt == 2:
-            _serialize_short(out, value, set_type)
-        elif byte_cnt <= 4:
-            _serialize_integer(out, value, set_type)
-        elif byte_cnt <= 8:
-            _serialize_long(out, value, set_type)
-    elif float == v_type:
-        _serialize_double(out, value, set_type)
-    elif bytearray == v_type:
-        _serialize_bytearray(out, value, set_type)
-    elif array.array == v_type:
-        _serialize_array(out, value, set_type)
-    elif dict == v_type:
-        _serialize_dict(out, value, set_type)
-    elif typed_dict == v_type:
-        _serialize_typed_dict(out, value, set_type)
-    elif list == v_type:
-        _serialize_list(out, value, set_type)
-    elif OperationRequest == v_type:
-        _serialize_op_request(out, value, set_type)
-    elif OperationResponse == v_type:
-        _serialize_op_response(out, value, set_type)
-    elif EventData == v_type:
-        _serialize_event_data(out, value, set_type)
+    func = _SERIALIZERS.get(type(value))
+    if func is None:
+        func = _find_in_table(_SERIALIZERS, type(value))
+
+    func(out, value, set_type)
+
+
+def _find_in_table(table, v_type):
+    for base in v_type.__mro__[1:]:
+        func = table.get(base)
+        if func is not None:
+            table[v_type] = func
+            return func
+
+    raise Exception("Cannot serialize value of type {}".format(v_type))
+
+
+def _int_size(value):
+    # widths are signed, so 128 already needs a short
+    byte_cnt = ((~value if value < 0 else value).bit_length() + 8) // 8
+
+    if byte_cnt <= 1:
+        return 1
+    elif byte_cnt == 2:
+        return 2
+    elif byte_cnt <= 4:
+        return 4
+    elif byte_cnt <= 8:
+        return 8
     else:
-        raise Exception("Cannot serialize value of type {}".format(v_type))
+        raise ValueError("Integer {} does not fit into 64 bits".format(value))
+
+
+def _serialize_int(out, value, set_type):
+    size = _int_size(value)
+
+    if size == 1:
+        _serialize_byte(out, value, set_type)
+    elif size == 2:
+        _serialize_short(out, value, set_type)
+    elif size == 4:
+        _serialize_integer(out, value, set_type)
+    else:
+        _serialize_long(out, value, set_type)
 
 
 def _serialize_parameters(out, params):
-    try:
-        if params is None:
-            params = {}
+    if params is None:
+        params = {}
 
-        _serialize_short(out, len(params), False)
+    _serialize_short(out, len(params), False)
 
-        for key in params:
-            _serialize_byte(out, key, False)
-            _serialize(out, params[key], True)
-    except:
-        traceback.print_exc()
+    for key in params:
+        _serialize_byte(out, key, False)
+        _serialize(out, params[key], True)
 
 
 def _serialize_string(out, value, set_type):
     if set_type:
-        out.extend(bytearray([115]))
+        out.append(115)
 
-    str_bytes = bytearray(value, "utf-8")
+    str_bytes = value.encode("utf-8")
     _serialize_short(out, len(str_bytes), False)
     out.extend(str_bytes)
 
 
 def _serialize_boolean(out, value, set_type):
     if set_type:
-        out.extend(bytearray([111]))
+        out.append(111)
 
     _serialize_byte(out, 1 if value is True else 0, False)
 
 
 def _serialize_byte(out, value, set_type):
     if set_type:
-        out.extend(bytearray([98]))
+        out.append(98)
 
-    value = ((value + ((1 << 7) - 1)) % (1 << 8)) - ((1 << 7) - 1)
-    out.extend(struct.pack('>b', value))
+    value = ((value + (1 << 7)) % (1 << 8)) - (1 << 7)
+    out.pack(_BYTE, value)
 
 
 def _serialize_short(out, value, set_type):
     if set_type:
-        out.extend(bytearray([107]))
+        out.append(107)
 
-    value = ((value + ((1 << 15) - 1)) % (1 << 16)) - ((1 << 15) - 1)
-    out.extend(struct.pack('>h', value))
+    value = ((value + (1 << 15)) % (1 << 16)) - (1 << 15)
+    out.pack(_SHORT, value)
 
 
 def _serialize_integer(out, value, set_type):
     if set_type:
-        out.extend(bytearray([105]))
+        out.append(105)
 
-    value = ((value + ((1 << 31) - 1)) % (1 << 32)) - ((1 << 31) - 1)
-    out.extend(struct.pack('>i', value))
+    value = ((value + (1 << 31)) % (1 << 32)) - (1 << 31)
+    out.pack(_INTEGER, value)
 
 
 def _serialize_long(out, value, set_type):
     if set_type:
-        out.extend(bytearray([108]))
+        out.append(108)
 
-    value = ((value + ((1 << 63) - 1)) % (1 << 64)) - ((1 << 63) - 1)
-    out.extend(struct.pack('>q', value))
+    value = ((value + (1 << 63)) % (1 << 64)) - (1 << 63)
+    out.pack(_LONG, value)
 
 
 def _serialize_float(out, value, set_type):
     if set_type:
-        out.extend(bytearray([102]))
+        out.append(102)
 
-    out.extend(struct.pack('>f', value))
+    out.pack(_FLOAT, value)
 
 
 def _serialize_double(out, value, set_type):
     if set_type:
-        out.extend(bytearray([100]))
+        out.append(100)
 
-    out.extend(struct.pack('>d', value))
+    out.pack(_DOUBLE, value)
 
 
 def _serialize_bytearray(out, value, set_type):
     if set_type:
-        out.extend(bytearray([120]))
+        out.append(120)
 
     _serialize_integer(out, len(value), False)
     out.extend(value)
@@ -188,15 +460,53 @@ def _serialize_bytearray(out, value, set_type):
 
 def _serialize_array(out, value, set_type):
     if set_type:
-        out.extend(bytearray([121]))
+        out.append(121)
 
     _serialize_short(out, len(value), False)
     code = _get_code_for_array_typecode(value.typecode)
-    func = _get_serialize_func_for_code(code)
 
     _serialize_byte(out, code, False)
-    for val in value:
-        func(out, val, False)
+    out.extend(_array_to_wire(value, code))
+
+
+def _array_to_wire(value, code):
+    """
+    Returns a copy of numeric array in network byte order with item size of the given type code.
+    """
+    if value.itemsize != _ARRAY_ITEM_SIZES[code]:
+        typecode = _ARRAY_TYPECODES[code]
+        value = array.array(typecode.upper() if value.typecode.isupper() else typecode, value)
+    elif _LITTLE_ENDIAN:
+        value = value[:]
+
+    if _LITTLE_ENDIAN:
+        value.byteswap()
+
+    return value
+
+
+def _get_code_for_ndarray(value):
+    if value.ndim != 1:
+        raise ValueError("Only one-dimensional numpy arrays are supported, got shape {}".format(value.shape))
+
+    code = _NUMPY_CODES.get((value.dtype.kind, value.dtype.itemsize))
+    if code is None:
+        raise Exception("Cannot serialize numpy array of dtype {}".format(value.dtype))
+
+    return code
+
+
+def _serialize_ndarray(out, value, set_type):
+    code = _get_code_for_ndarray(value)
+
+    if set_type:
+        out.append(121)
+
+    _serialize_short(out, len(value), False)
+    _serialize_byte(out, code, False)
+
+    wire_dtype = numpy.dtype(value.dtype.kind + str(value.dtype.itemsize)).newbyteorder('>')
+    out.extend(numpy.ascontiguousarray(value, dtype=wire_dtype).tobytes())
 
 
 def _serialize_list(out, value, set_type):
@@ -208,7 +518,7 @@ def _serialize_list(out, value, set_type):
         raise ValueError("List must be not empty")
 
     if set_type:
-        out.extend(bytearray([121]))
+        out.append(121)
 
     _serialize_short(out, len(value), False)
     _serialize_byte(out, 115, False)
@@ -219,7 +529,7 @@ def _serialize_list(out, value, set_type):
 
 def _serialize_dict(out, value, set_type):
     if set_type:
-        out.extend(bytearray([104]))
+        out.append(104)
 
     _serialize_short(out, len(value), False)
 
@@ -233,51 +543,45 @@ def _serialize_dict(out, value, set_type):
 
 def _serialize_typed_dict(out, value, set_type):
     if set_type:
-        out.extend(bytearray([68]))
-
-    if object == value.key_type:
-        _serialize_byte(out, 0, False)
-    else:
-        _serialize_byte(out, _get_code_for_type(value.key_type), False)
+        out.append(68)
 
-    if object == value.value_type:
-        _serialize_byte(out, 0, False)
-    else:
-        _serialize_byte(out, _get_code_for_type(value.value_type), False)
+    key_code = _get_code_for_type(value.key_type)
+    value_code = _get_code_for_type(value.value_type)
 
+    _serialize_byte(out, key_code, False)
+    _serialize_byte(out, value_code, False)
     _serialize_short(out, len(value), False)
 
+    key_func = _serialize if key_code in _TYPE_DISPATCHED_CODES else _get_serialize_func_for_code(key_code)
+    value_func = _serialize if value_code in _TYPE_DISPATCHED_CODES else _get_serialize_func_for_code(value_code)
+
     for key in value:
         if key is None:
             raise ValueError("None keys are now allowed for dict!")
 
-        _serialize(out, key, object == value.key_type)
-
-        if int is value.value_type:
-            _serialize_integer(out, value[key], False)
-        else:
-            _serialize(out, value[key], object == value.value_type)
+        key_func(out, key, key_code == 0)
+        value_func(out, value[key], value_code == 0)
 
 
 def _serialize_event_data(out, value, set_type):
     if set_type:
-        out.extend(bytearray([101]))
+        out.append(101)
 
-    out.extend(bytearray([value.code]))
+    out.append(value.code)
     _serialize_parameters(out, value.params)
 
 
 def _serialize_op_request(out, value, set_type):
     if set_type:
-        out.extend(bytearray([113]))
+        out.append(113)
 
-    out.extend(bytearray([value.op_code]))
+    out.append(value.op_code)
     _serialize_parameters(out, value.params)
 
 
 def _serialize_op_response(out, value, set_type):
     if set_type:
-        out.extend(bytearray([112]))
+        out.append(112)
 
     _serialize_byte(out, value.op_code, False)
     _serialize_short(out, value.return_code, False)
@@ -291,324 +595,622 @@ def _serialize_op_response(out, value, set_type):
     _serialize_parameters(out, value.params)
 
 
-def _deserialize(buf, v_type=None):
-    if v_type is None:
-        v_type = _deserialize_byte(buf)
-
-    if v_type == 0 or v_type == 42:
-        return None
-    elif v_type == 115:
-        return _deserialize_string(buf)
-    elif v_type == 111:
-        return _deserialize_boolean(buf)
-    elif v_type == 98:
-        return _deserialize_byte(buf)
-    elif v_type == 107:
-        return _deserialize_short(buf)
-    elif v_type == 105:
-        return _deserialize_integer(buf)
-    elif v_type == 108:
-        return _deserialize_long(buf)
-    elif v_type == 102:
-        return _deserialize_float(buf)
-    elif v_type == 100:
-        return _deserialize_double(buf)
-    elif v_type == 120:
-        return _deserialize_bytearray(buf)
-    elif v_type == 121:
-        return _deserialize_array(buf)
-    elif v_type == 104:
-        return _deserialize_dict(buf)
-    elif v_type == 68:
-        return _deserialize_typed_dict(buf)
-    elif v_type == 113:
-        return deserialize_op_request(buf)
-    elif v_type == 112:
-        return deserialize_op_response(buf)
-    elif v_type == 101:
-        return deserialize_event_data(buf)
+# size calculation, mirrors the serializers above
+
+
+def _fixed_size(size):
+    def size_func(value, set_type):
+        return size + 1 if set_type else size
+
+    return size_func
+
+
+def _size_int(value, set_type):
+    return _int_size(value) + (1 if set_type else 0)
+
+
+def _size_parameters(params):
+    size = 2
+
+    if params is not None:
+        for key in params:
+            size += 1 + calc_size(params[key], True)
+
+    return size
+
+
+def _size_string(value, set_type):
+    return (3 if set_type else 2) + (len(value) if value.isascii() else len(value.encode("utf-8")))
+
+
+def _size_bytearray(value, set_type):
+    return (5 if set_type else 4) + len(value)
+
+
+def _size_array(value, set_type):
+    code = _get_code_for_array_typecode(value.typecode)
+    return (4 if set_type else 3) + len(value) * _ARRAY_ITEM_SIZES[code]
+
+
+def _size_ndarray(value, set_type):
+    _get_code_for_ndarray(value)
+    return (4 if set_type else 3) + len(value) * value.dtype.itemsize
+
+
+def _size_list(value, set_type):
+    if len(value) == 0:
+        raise ValueError("List must be not empty")
+
+    size = 4 if set_type else 3
+    for val in value:
+        size += _size_string(val, False)
+
+    return size
+
+
+def _size_dict(value, set_type):
+    size = 3 if set_type else 2
+    for key in value:
+        size += calc_size(key, True) + calc_size(value[key], True)
+
+    return size
+
+
+def _size_typed_dict(value, set_type):
+    key_code = _get_code_for_type(value.key_type)
+    value_code = _get_code_for_type(value.value_type)
+
+    key_func = calc_size if key_code in _TYPE_DISPATCHED_CODES else _get_size_func_for_code(key_code)
+    value_func = calc_size if value_code in _TYPE_DISPATCHED_CODES else _get_size_func_for_code(value_code)
+
+    size = 5 if set_type else 4
+    for key in value:
+        size += key_func(key, key_code == 0) + value_func(value[key], value_code == 0)
+
+    return size
+
+
+def _size_event_data(value, set_type):
+    return (2 if set_type else 1) + _size_parameters(value.params)
+
+
+def _size_op_request(value, set_type):
+    return (2 if set_type else 1) + _size_parameters(value.params)
+
+
+def _size_op_response(value, set_type):
+    size = 4 if set_type else 3
+
+    if value.debug_message is None or len(value.debug_message) == 0:
+        size += 1
     else:
-        raise Exception("Cannot serialize value of type {}".format(v_type))
+        size += 1 + _size_string(value.debug_message, False)
 
+    return size + _size_parameters(value.params)
 
-def _deserialize_parameters(buf):
+
+def _measured_size(serialize_func):
+    """
+    Size function for types registered without one: runs the serializer against a byte counter.
+    """
+    def size_func(value, set_type):
+        counter = _ByteCounter()
+        serialize_func(counter, value, set_type)
+        return counter.pos
+
+    return size_func
+
+
+def _deserialize(reader, v_type=None):
+    if v_type is None:
+        v_type = _deserialize_byte(reader)
+
+    func = _DESERIALIZERS.get(v_type)
+    if func is None:
+        raise Exception("Cannot deserialize value of type {}".format(v_type))
+
+    return func(reader)
+
+
+def _deserialize_null(reader):
+    return None
+
+
+def _deserialize_parameters(reader):
     params = {}
 
-    length = _deserialize_short(buf)
+    length = _deserialize_short(reader)
     for i in range(length):
-        key = _deserialize_byte(buf)
-        value = _deserialize(buf)
+        key = _deserialize_byte(reader)
+        value = _deserialize(reader)
         params[key] = value
 
     return params
 
 
-def _deserialize_string(buf):
-    length = _deserialize_short(buf)
-    return _fetch_bytes(buf, length).decode("utf-8")
+def _deserialize_string(reader):
+    length = _deserialize_short(reader)
+    return str(reader.read(length), "utf-8")
 
 
-def _deserialize_boolean(buf):
-    return _deserialize_byte(buf) == 1
+def _deserialize_boolean(reader):
+    return _deserialize_byte(reader) == 1
 
 
-def _deserialize_byte(buf):
-    return struct.unpack('>b', _fetch_bytes(buf, 1))[0]
+def _deserialize_byte(reader):
+    return reader.unpack(_BYTE)
 
 
-def _deserialize_short(buf):
-    return struct.unpack('>h', _fetch_bytes(buf, 2))[0]
+def _deserialize_short(reader):
+    return reader.unpack(_SHORT)
 
 
-def _deserialize_integer(buf):
-    return struct.unpack('>i', _fetch_bytes(buf, 4))[0]
+def _deserialize_integer(reader):
+    return reader.unpack(_INTEGER)
 
 
-def _deserialize_long(buf):
-    return struct.unpack('>q', _fetch_bytes(buf, 8))[0]
+def _deserialize_long(reader):
+    return reader.unpack(_LONG)
 
 
-def _deserialize_float(buf):
-    return struct.unpack('>f', _fetch_bytes(buf, 4))[0]
+def _deserialize_float(reader):
+    return reader.unpack(_FLOAT)
 
 
-def _deserialize_double(buf):
-    return struct.unpack('>d', _fetch_bytes(buf, 8))[0]
+def _deserialize_double(reader):
+    return reader.unpack(_DOUBLE)
 
 
-def _deserialize_bytearray(buf):
-    length = _deserialize_integer(buf)
-    return _fetch_bytes(buf, length)
+def _deserialize_bytearray(reader):
+    length = _deserialize_integer(reader)
+    return bytearray(reader.read(length))
 
 
-def _deserialize_array(buf):
-    length = _deserialize_short(buf)
-    code = _deserialize_byte(buf)
+def _deserialize_array(reader):
+    length = _deserialize_short(reader)
+    code = _deserialize_byte(reader)
 
-    if code == 115:
-        result = []
+    typecode = _ARRAY_TYPECODES.get(code)
+    if typecode is not None and reader.numpy_arrays:
+        dtype = _NUMPY_DTYPES[code]
+        data = reader.read(length * dtype.itemsize)
 
-        for i in range(length):
-            result.append(_deserialize_string(buf))
+        # astype() swaps into native order and detaches the result from the payload buffer
+        return numpy.frombuffer(data, dtype=dtype).astype(dtype.newbyteorder('='))
+    elif typecode is not None:
+        result = array.array(typecode)
+        result.frombytes(reader.read(length * result.itemsize))
+
+        if _LITTLE_ENDIAN:
+            result.byteswap()
 
         return result
     else:
-        typecode = _get_array_typecode_for_code(code)
         func = _get_deserialize_func_for_code(code)
 
-        result = array.array(typecode)
+        result = []
         for i in range(length):
-            result.append(func(buf))
+            result.append(func(reader))
 
         return result
 
 
-def _deserialize_dict(buf):
-    length = _deserialize_short(buf)
+def _deserialize_dict(reader):
+    length = _deserialize_short(reader)
 
     result = {}
     for i in range(length):
-        result[_deserialize(buf)] = _deserialize(buf)
+        key = _deserialize(reader)
+        result[key] = _deserialize(reader)
 
     return result
 
 
-def _deserialize_typed_dict(buf):
+def _deserialize_typed_dict(reader):
 
-    key_type_code = _deserialize_byte(buf)
-    value_type_code = _deserialize_byte(buf)
+    key_type_code = _deserialize_byte(reader)
+    value_type_code = _deserialize_byte(reader)
 
     result = typed_dict(_get_type_for_code(key_type_code), _get_type_for_code(value_type_code))
 
     read_key_type = key_type_code == 0 or key_type_code == 42
     read_value_type = value_type_code == 0 or value_type_code == 42
 
-    length = _deserialize_short(buf)
+    length = _deserialize_short(reader)
     for i in range(length):
-        key = _deserialize(buf, None if read_key_type else key_type_code)
-        value = _deserialize(buf, None if read_value_type else value_type_code)
+        key = _deserialize(reader, None if read_key_type else key_type_code)
+        value = _deserialize(reader, None if read_value_type else value_type_code)
         result[key] = value
 
     return result
 
 
-def _get_serialize_func_for_code(code):
-    if code is 115:
-        return _serialize_string
-    if code is 111:
-        return _serialize_boolean
-    if code is 98:
-        return _serialize_byte
-    if code is 107:
-        return _serialize_short
-    if code is 105:
-        return _serialize_integer
-    if code is 108:
-        return _serialize_long
-    if code is 102:
-        return _serialize_float
-    if code is 100:
-        return _serialize_double
-    if code is 120:
-        return _serialize_bytearray
-    if code is 121:
-        return _serialize_array
-    if code is 104:
-        return _serialize_dict
-    if code is 101:
-        return _serialize_event_data
-    if code is 113:
-        return _serialize_op_request
-    if code is 112:
-        return _serialize_op_response
+# skipping, moves reader past a value without decoding it
+
+
+def _skip(reader, v_type=None):
+    if v_type is None:
+        v_type = reader.view[reader.pos]
+        reader.pos += 1
+
+    size = _SKIP_SIZES.get(v_type)
+    if size is not None:
+        reader.skip(size)
+        return
+
+    func = _SKIPPERS.get(v_type)
+    if func is not None:
+        func(reader)
+    else:
+        _deserialize(reader, v_type)
+
+
+def _skip_parameters(reader):
+    length = _deserialize_short(reader)
+    for i in range(length):
+        reader.skip(1)
+        _skip(reader)
+
+
+def _skip_string(reader):
+    reader.skip(_deserialize_short(reader))
+
+
+def _skip_bytearray(reader):
+    reader.skip(_deserialize_integer(reader))
+
+
+def _skip_array(reader):
+    length = _deserialize_short(reader)
+    code = _deserialize_byte(reader)
+
+    item_size = _ARRAY_ITEM_SIZES.get(code)
+    if item_size is not None:
+        reader.skip(length * item_size)
     else:
+        for i in range(length):
+            _skip(reader, code)
+
+
+def _skip_dict(reader):
+    length = _deserialize_short(reader)
+    for i in range(length):
+        _skip(reader)
+        _skip(reader)
+
+
+def _skip_typed_dict(reader):
+    key_type_code = _deserialize_byte(reader)
+    value_type_code = _deserialize_byte(reader)
+
+    read_key_type = key_type_code == 0 or key_type_code == 42
+    read_value_type = value_type_code == 0 or value_type_code == 42
+
+    length = _deserialize_short(reader)
+    for i in range(length):
+        _skip(reader, None if read_key_type else key_type_code)
+        _skip(reader, None if read_value_type else value_type_code)
+
+
+def _skip_event_data(reader):
+    reader.skip(1)
+    _skip_parameters(reader)
+
+
+def _skip_op_request(reader):
+    reader.skip(1)
+    _skip_parameters(reader)
+
+
+def _skip_op_response(reader):
+    reader.skip(3)
+    _skip(reader)
+    _skip_parameters(reader)
+
+
+def _get_serialize_func_for_code(code):
+    func = _CODE_SERIALIZERS.get(code)
+    if func is None:
+        raise Exception("Unknown code: {}".format(code))
+
+    return func
+
+
+def _get_size_func_for_code(code):
+    func = _CODE_SIZES.get(code)
+    if func is None:
         raise Exception("Unknown code: {}".format(code))
 
+    return func
+
 
 def _get_deserialize_func_for_code(code):
-    if code is 115:
-        return _deserialize_string
-    if code is 111:
-        return _deserialize_boolean
-    if code is 98:
-        return _deserialize_byte
-    if code is 107:
-        return _deserialize_short
-    if code is 105:
-        return _deserialize_integer
-    if code is 108:
-        return _deserialize_long
-    if code is 102:
-        return _deserialize_float
-    if code is 100:
-        return _deserialize_double
-    if code is 120:
-        return _deserialize_bytearray
-    if code is 121:
-        return _deserialize_array
-    if code is 104:
-        return _deserialize_dict
-    if code is 101:
-        return deserialize_event_data
-    if code is 113:
-        return deserialize_op_request
-    if code is 112:
-        return deserialize_op_response
-    else:
+    func = _DESERIALIZERS.get(code)
+    if func is None:
         raise Exception("Unknown code: {}".format(code))
 
+    return func
+
 
 def _get_code_for_array_typecode(typecode):
-    if typecode is 'b' or typecode is 'B':
-        return 98
-    if typecode is 'h' or typecode is 'H':
-        return 107
-    if typecode is 'i' or typecode is 'I':
-        return 105
-    if typecode is 'l' or typecode is 'L':
-        return 108
-    if typecode is 'q' or typecode is 'Q':
-        return 108
-    if typecode is 'f':
-        return 102
-    if typecode is 'd':
-        return 100
-    else:
+    code = _ARRAY_CODES.get(typecode)
+    if code is None:
         raise Exception("Unknown typecode: {}".format(typecode))
 
+    return code
+
 
 def _get_array_typecode_for_code(code):
-    if code is 98:
-        return 'b'
-    if code is 107:
-        return 'h'
-    if code is 105:
-        return 'i'
-    if code is 108:
-        return 'q'
-    if code is 102:
-        return 'f'
-    if code is 100:
-        return 'd'
-    else:
+    typecode = _ARRAY_TYPECODES.get(code)
+    if typecode is None:
         raise Exception("Unknown code: {}".format(code))
 
+    return typecode
 
-def _get_code_for_type(v_type, value=None):
-    if v_type is None:
-        return 42
-    elif str == v_type:
-        return 115
-    elif bool == v_type:
-        return 111
-    elif int == v_type:
-        if value is None:
-            return 105
-
-        byte_cnt = (value.bit_length() + 7) // 8
-
-        if byte_cnt == 1:
-            return 98
-        elif byte_cnt == 2:
-            return 107
-        elif byte_cnt <= 4:
-            return 105
-        elif byte_cnt <= 8:
-            return 108
-    elif float == v_type:
-        return 100
-    elif bytearray == v_type:
-        return 120
-    elif array.array == v_type:
-        return 121
-    elif dict == v_type:
-        return 104
-    elif typed_dict == v_type:
-        return 68
-    elif list == v_type:
-        return 121
-    elif OperationRequest == v_type:
-        return 113
-    elif OperationResponse == v_type:
-        return 112
-    elif EventData == v_type:
-        return 101
-    else:
+
+def _get_code_for_type(v_type):
+    code = _TYPE_CODES.get(v_type)
+    if code is None:
         raise Exception("Cannot serialize value of type {}".format(v_type))
 
+    return code
+
+
+def _get_code_for_value(value):
+    if type(value) is int:
+        return _INT_CODES[_int_size(value)]
+
+    return _get_code_for_type(type(value))
+
 
 def _get_type_for_code(code):
-    if code == 42 or code == 0:
-        return object
-    elif code == 115:
-        return str
-    elif code == 111:
-        return bool
-    elif code == 98 or code == 107 or code == 105 or code == 108:
-        return int
-    elif code == 102 or code == 100:
-        return float
-    elif code == 120:
-        return bytearray
-    elif code == 121:
-        return array.array
-    elif code == 104:
-        return dict
-    elif code == 68:
-        return typed_dict
-    elif code == 113:
-        return OperationRequest
-    elif code == 112:
-        return OperationResponse
-    elif code == 101:
-        return EventData
-    else:
-        raise Exception("Cannot serialize value of type {}".format(v_type))
+    v_type = _CODE_TYPES.get(code)
+    if v_type is None:
+        raise Exception("Cannot deserialize value of type {}".format(code))
+
+    return v_type
 
 
-def _fetch_bytes(buf, count):
-    res = buf[0:count]
-    for i in range(0, count):
-        buf.pop(0)
+def register_type(v_type, code, serialize_func, deserialize_func, size_func=None):
+    """
+    Adds a type to the codec tables used by every (de)serialization path.
 
-    return res
\ No newline at end of file
+    serialize_func(out, value, set_type) must write the type code itself when set_type is True,
+    out is a ByteWriter which supports append(), extend() and pack(struct, value).
+    deserialize_func(reader) receives a ByteReader positioned right after the type code.
+    size_func(value, set_type) returns serialized size, when omitted it is measured by running serialize_func.
+    """
+    if size_func is None:
+        size_func = _measured_size(serialize_func)
+
+    _SKIP_SIZES.pop(code, None)
+    _SKIPPERS.pop(code, None)
+
+    _SIZES[v_type] = size_func
+    _CODE_SIZES[code] = size_func
+    _SERIALIZERS[v_type] = serialize_func
+    _TYPE_CODES[v_type] = code
+    _CODE_SERIALIZERS[code] = serialize_func
+    _DESERIALIZERS[code] = deserialize_func
+    _CODE_TYPES[code] = v_type
+
+
+# codec tables
+
+_SERIALIZERS = {
+    str: _serialize_string,
+    bool: _serialize_boolean,
+    int: _serialize_int,
+    float: _serialize_double,
+    bytearray: _serialize_bytearray,
+    array.array: _serialize_array,
+    dict: _serialize_dict,
+    typed_dict: _serialize_typed_dict,
+    list: _serialize_list,
+    OperationRequest: _serialize_op_request,
+    OperationResponse: _serialize_op_response,
+    EventData: _serialize_event_data,
+}
+
+_SIZES = {
+    str: _size_string,
+    bool: _fixed_size(1),
+    int: _size_int,
+    float: _fixed_size(8),
+    bytearray: _size_bytearray,
+    array.array: _size_array,
+    dict: _size_dict,
+    typed_dict: _size_typed_dict,
+    list: _size_list,
+    OperationRequest: _size_op_request,
+    OperationResponse: _size_op_response,
+    EventData: _size_event_data,
+}
+
+_TYPE_CODES = {
+    None: 42,
+    object: 0,
+    str: 115,
+    bool: 111,
+    int: 105,
+    float: 100,
+    bytearray: 120,
+    array.array: 121,
+    dict: 104,
+    typed_dict: 68,
+    list: 121,
+    OperationRequest: 113,
+    OperationResponse: 112,
+    EventData: 101,
+}
+
+# typed dict entries of these codes are serialized by their own type: 0 is any type, 121 is written for
+# array.array, list and numpy arrays alike
+_TYPE_DISPATCHED_CODES = frozenset([0, 121])
+
+_CODE_SERIALIZERS = {
+    115: _serialize_string,
+    111: _serialize_boolean,
+    98: _serialize_byte,
+    107: _serialize_short,
+    105: _serialize_integer,
+    108: _serialize_long,
+    102: _serialize_float,
+    100: _serialize_double,
+    120: _serialize_bytearray,
+    121: _serialize_array,
+    104: _serialize_dict,
+    68: _serialize_typed_dict,
+    101: _serialize_event_data,
+    113: _serialize_op_request,
+    112: _serialize_op_response,
+}
+
+_CODE_SIZES = {
+    115: _size_string,
+    111: _fixed_size(1),
+    98: _fixed_size(1),
+    107: _fixed_size(2),
+    105: _fixed_size(4),
+    108: _fixed_size(8),
+    102: _fixed_size(4),
+    100: _fixed_size(8),
+    120: _size_bytearray,
+    121: calc_size,
+    104: _size_dict,
+    68: _size_typed_dict,
+    101: _size_event_data,
+    113: _size_op_request,
+    112: _size_op_response,
+}
+
+_DESERIALIZERS = {
+    0: _deserialize_null,
+    42: _deserialize_null,
+    115: _deserialize_string,
+    111: _deserialize_boolean,
+    98: _deserialize_byte,
+    107: _deserialize_short,
+    105: _deserialize_integer,
+    108: _deserialize_long,
+    102: _deserialize_float,
+    100: _deserialize_double,
+    120: _deserialize_bytearray,
+    121: _deserialize_array,
+    104: _deserialize_dict,
+    68: _deserialize_typed_dict,
+    113: deserialize_op_request,
+    112: deserialize_op_response,
+    101: deserialize_event_data,
+}
+
+_SKIP_SIZES = {
+    0: 0,
+    42: 0,
+    111: 1,
+    98: 1,
+    107: 2,
+    105: 4,
+    108: 8,
+    102: 4,
+    100: 8,
+}
+
+_SKIPPERS = {
+    115: _skip_string,
+    120: _skip_bytearray,
+    121: _skip_array,
+    104: _skip_dict,
+    68: _skip_typed_dict,
+    113: _skip_op_request,
+    112: _skip_op_response,
+    101: _skip_event_data,
+}
+
+_CODE_TYPES = {
+    0: object,
+    42: object,
+    115: str,
+    111: bool,
+    98: int,
+    107: int,
+    105: int,
+    108: int,
+    102: float,
+    100: float,
+    120: bytearray,
+    121: array.array,
+    104: dict,
+    68: typed_dict,
+    113: OperationRequest,
+    112: OperationResponse,
+    101: EventData,
+}
+
+_ARRAY_CODES = {
+    'b': 98, 'B': 98,
+    'h': 107, 'H': 107,
+    'i': 105, 'I': 105,
+    'l': 108, 'L': 108,
+    'q': 108, 'Q': 108,
+    'f': 102,
+    'd': 100,
+}
+
+_ARRAY_TYPECODES = {
+    98: 'b',
+    107: 'h',
+    105: 'i',
+    108: 'q',
+    102: 'f',
+    100: 'd',
+}
+
+_INT_CODES = {
+    1: 98,
+    2: 107,
+    4: 105,
+    8: 108,
+}
+
+_FIXED_STRUCTS = {
+    111: _BYTE,
+    98: _BYTE,
+    107: _SHORT,
+    105: _INTEGER,
+    108: _LONG,
+    102: _FLOAT,
+    100: _DOUBLE,
+}
+
+_ARRAY_ITEM_SIZES = {
+    98: 1,
+    107: 2,
+    105: 4,
+    108: 8,
+    102: 4,
+    100: 8,
+}
+
+if numpy is not None:
+    _SERIALIZERS[numpy.ndarray] = _serialize_ndarray
+    _SIZES[numpy.ndarray] = _size_ndarray
+    _TYPE_CODES[numpy.ndarray] = 121
+
+    _NUMPY_CODES = {
+        ('i', 1): 98, ('u', 1): 98,
+        ('i', 2): 107, ('u', 2): 107,
+        ('i', 4): 105, ('u', 4): 105,
+        ('i', 8): 108, ('u', 8): 108,
+        ('f', 4): 102,
+        ('f', 8): 100,
+    }
+
+    _NUMPY_DTYPES = {
+        98: numpy.dtype('>i1'),
+        107: numpy.dtype('>i2'),
+        105: numpy.dtype('>i4'),
+        108: numpy.dtype('>i8'),
+        102: numpy.dtype('>f4'),
+        100: numpy.dtype('>f8'),
+    }
@@ -0,0 +1,105 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# tolerance for float error when comparing tokens, so that waiting exactly delay() is enough
+_EPSILON = 1e-9
+
+
+class TokenBucket:
+    """
+    Fills with rate tokens per second up to capacity. Taking more tokens than there are is allowed when
+    enough of them are there, the bucket goes into debt then and the next takes wait for it to be paid off.
+    Amount larger than capacity needs a full bucket.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None and now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+        self.updated = now
+
+    def delay(self, amount, now):
+        """
+        Returns seconds until amount can be taken, 0 if it can be taken now.
+        """
+        self.refill(now)
+
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= _EPSILON:
+            return 0
+
+        return missing / self.rate
+
+    def take(self, amount, now):
+        self.refill(now)
+        self.tokens -= amount
+
+
+class RateLimit:
+    """
+    Limits messages per second and bytes per second, None means no limit. Burst is how much may leave at once
+    after idle time, by default a tenth of a second worth of rate (but at least one message), so sending is
+    paced evenly instead of in second long bursts.
+    """
+    __slots__ = ("messages", "bytes")
+
+    def __init__(self, messages_per_second=None, bytes_per_second=None, burst_messages=None, burst_bytes=None):
+        self.messages = None
+        self.bytes = None
+
+        for rate in (messages_per_second, bytes_per_second):
+            if rate is not None and rate <= 0:
+                raise ValueError("Rate must be positive, got {}".format(rate))
+
+        if messages_per_second is not None:
+            if burst_messages is None:
+                burst_messages = max(1, messages_per_second / 10)
+
+            self.messages = TokenBucket(messages_per_second, burst_messages)
+
+        if bytes_per_second is not None:
+            if burst_bytes is None:
+                burst_bytes = bytes_per_second / 10
+
+            self.bytes = TokenBucket(bytes_per_second, burst_bytes)
+
+    def delay(self, size, now):
+        """
+        Returns seconds until a message of size bytes may be sent, 0 if it may be sent now.
+        """
+        delay = 0
+
+        if self.messages is not None:
+            delay = self.messages.delay(1, now)
+
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.delay(size, now))
+
+        return delay
+
+    def take(self, size, now):
+        if self.messages is not None:
+            self.messages.take(1, now)
+
+        if self.bytes is not None:
+            self.bytes.take(size, now)
@@ -0,0 +1,383 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import errno
+import selectors
+import socket
+import threading
+import time
+import traceback
+from photon.enums import DebugLevel, StatusCode, TraceStage
+from photon.framing import FrameParser
+from photon.tconnect import send_messages
+
+
+class Reactor:
+    """
+    One I/O thread for the sockets of many peers. Pass it to PhotonPeer to use it instead of a thread per connection:
+
+        reactor = Reactor()
+        pp = PhotonPeer(ConnectionProtocol.Tcp, listener, reactor=reactor)
+
+    The thread starts with the first connection and runs until stop(), a stopped reactor can't be used again.
+    """
+
+    def __init__(self, recv_size=65536):
+        self.recv_size = recv_size
+
+        self.selector = selectors.DefaultSelector()
+        self._calls = collections.deque()
+        self._calls_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._stopped = False
+
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+
+    def create_connection(self, pp, host, port):
+        self.start()
+
+        return ReactorTConnect(pp, host, port, self)
+
+    def start(self):
+        with self._calls_lock:
+            if self._thread is not None:
+                return
+
+            if self._stopped:
+                raise Exception("Reactor was stopped, it can't be started again")
+
+            self._running = True
+            self._thread = threading.Thread(target=self.run, name="PhotonReactor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._stopped = True
+
+        if self._thread is None:
+            # never started, run() would close these
+            self._close()
+            return
+
+        self._wake()
+
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+        self._thread = None
+
+    def is_reactor_thread(self):
+        return self._thread is threading.current_thread()
+
+    def call_soon(self, func):
+        """
+        Runs func on the reactor thread.
+        """
+        with self._calls_lock:
+            self._calls.append(func)
+
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b"\0")
+        except OSError:
+            # full (a wakeup is pending anyway) or closed by stop()
+            pass
+
+    def run(self):
+        while self._running:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    self._drain_wakeup()
+                else:
+                    self._handle_events(key.data, mask)
+
+            with self._calls_lock:
+                calls = self._calls
+                self._calls = collections.deque()
+
+            for func in calls:
+                try:
+                    func()
+                except Exception:
+                    traceback.print_exc()
+
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+
+        self._close()
+
+    def _handle_events(self, connection, mask):
+        """
+        Errors of one connection (listener, trace hooks...) fail only that connection, not the shared thread.
+        """
+        try:
+            connection.handle_events(mask)
+        except Exception as e:
+            traceback.print_exc()
+
+            try:
+                connection._fail("Connection failed. Exception: {}".format(e))
+            except Exception:
+                traceback.print_exc()
+
+    def _close(self):
+        self.selector.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_read.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+
+class ReactorTConnect:
+    """
+    TConnect counterpart whose non-blocking socket is read and written by a Reactor.
+    """
+
+    def __init__(self, pp, host, port, reactor):
+        self.pp = pp
+        self.host = host
+        self.port = port
+        self.reactor = reactor
+
+        self.connection = None
+        self.is_connected = False
+        self.obsolete = False
+
+        self.parser = FrameParser()
+        self.out_buffer = bytearray()
+        self.out_lock = threading.Lock()
+        self.closed = threading.Event()
+
+    def is_running(self):
+        return self.is_connected and not self.obsolete
+
+    def start_connection(self):
+        try:
+            self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connection.setblocking(False)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except Exception as e:
+            if self.pp.debug_level >= DebugLevel.Error:
+                self.pp.log(DebugLevel.Error, e)
+            self.pp.peer_listener.on_status_changed(StatusCode.ExceptionOnConnect)
+            self.pp.peer_listener.on_status_changed(StatusCode.Disconnect)
+
+            return False
+
+        self.obsolete = False
+        self.is_connected = False
+        self.closed.clear()
+        self.reactor.call_soon(self._connect)
+
+        return True
+
+    def _connect(self):
+        result = self.connection.connect_ex((self.host, self.port))
+
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._fail("Connect failed. Error: {}".format(errno.errorcode.get(result, result)), True)
+            return
+
+        self.reactor.selector.register(self.connection, selectors.EVENT_WRITE, self)
+
+    def handle_events(self, mask):
+        if not self.is_connected:
+            error = self.connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._fail("Connect failed. Error: {}".format(errno.errorcode.get(error, error)), True)
+                return
+
+            self.is_connected = True
+            self._update_interest()
+            self.pp.notify_service()
+            return
+
+        if mask & selectors.EVENT_READ:
+            self._read()
+
+        if mask & selectors.EVENT_WRITE and not self.obsolete:
+            with self.out_lock:
+                self._flush()
+                drained = len(self.out_buffer) == 0
+
+            self._update_interest()
+
+            if drained:
+                self.pp.notify_service()
+
+    def _read(self):
+        while not self.obsolete:
+            try:
+                data = self.connection.recv(self.reactor.recv_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._fail("Receiving failed. SocketException: {}".format(e))
+                return
+
+            if not data:
+                self._fail("Receiving failed. Connection closed by remote host")
+                return
+
+            if self.pp.traffic_stats_enabled:
+                self.pp.traffic_stats_incoming.totalPacketCount += 1
+
+            hooks = self.pp.trace_hooks
+            if hooks:
+                received = time.perf_counter_ns()
+
+            capture = self.pp.capture
+
+            try:
+                messages = self.parser.feed(data, capture.incoming if capture is not None else None)
+            except ValueError as e:
+                self._fail("Receiving failed. {}".format(e))
+                return
+
+            for message in messages:
+                self.pp.receive_incoming_commands(message)
+
+            if hooks:
+                self.pp.trace(TraceStage.Receive, received, time.perf_counter_ns(), len(data))
+
+            if len(data) < self.reactor.recv_size:
+                return
+
+    def is_writable(self):
+        return len(self.out_buffer) == 0
+
+    def send_tcp(self, data):
+        self.send_batch([data])
+
+    def send_batch(self, messages):
+        if self.obsolete:
+            if self.pp.debug_level >= DebugLevel.Info:
+                self.pp.log(DebugLevel.Info, "Sending was skipped because connection is obsolete.",
+                            messages=len(messages))
+
+            return
+
+        capture = self.pp.capture
+        if capture is not None:
+            for data in messages:
+                capture.outgoing(data)
+
+        with self.out_lock:
+            was_empty = len(self.out_buffer) == 0
+
+            if was_empty:
+                try:
+                    messages = send_messages(self.connection, messages, self.pp.send_stats)
+                except OSError as e:
+                    self._send_failed(e)
+                    return
+
+            # whatever the socket didn't take is copied, messages may be pooled buffers
+            for data in messages:
+                self.out_buffer += data
+
+            wants_write = len(self.out_buffer) > 0
+
+        if was_empty and wants_write:
+            self.reactor.call_soon(self._update_interest)
+
+    def _flush(self):
+        """
+        Writes as much of out_buffer as the socket takes. Must be called with out_lock held.
+        """
+        try:
+            tail = send_messages(self.connection, [self.out_buffer], self.pp.send_stats)
+        except OSError as e:
+            self._send_failed(e)
+            return
+
+        unsent = sum(len(data) for data in tail)
+        # views of out_buffer have to be gone before it can be resized
+        del tail
+        del self.out_buffer[:len(self.out_buffer) - unsent]
+
+    def _send_failed(self, e):
+        self.obsolete = True
+        self.out_buffer = bytearray()
+
+        if self.pp.debug_level >= DebugLevel.Error:
+            self.pp.enqueue_debug_return(DebugLevel.Error, "TCP send failed. Exception: {}", e)
+
+    def _update_interest(self):
+        if self.obsolete or not self.is_connected:
+            return
+
+        events = selectors.EVENT_READ
+        if self.out_buffer:
+            events |= selectors.EVENT_WRITE
+
+        try:
+            self.reactor.selector.modify(self.connection, events, self)
+        except (KeyError, ValueError):
+            pass
+
+    def _fail(self, message, on_connect=False):
+        if not self.obsolete:
+            self.obsolete = True
+
+            if self.pp.debug_level >= DebugLevel.Error:
+                self.pp.enqueue_debug_return(DebugLevel.Error, message)
+
+            if on_connect:
+                self.pp.enqueue_status_callback(StatusCode.ExceptionOnConnect)
+                self.pp.enqueue_status_callback(StatusCode.Disconnect)
+
+        self.close()
+
+    def close(self):
+        self.is_connected = False
+
+        try:
+            self.reactor.selector.unregister(self.connection)
+        except (KeyError, ValueError):
+            pass
+
+        self.connection.close()
+        self.closed.set()
+
+    def stop_connection(self):
+        if self.connection is None:
+            return
+
+        self.obsolete = True
+
+        if self.reactor.is_reactor_thread() or not self.reactor._running:
+            self.close()
+        else:
+            self.reactor.call_soon(self.close)
+
+            # queued calls don't run once the reactor stops, it may be stopping right now
+            while not self.closed.wait(0.1):
+                if not self.reactor._running:
+                    self.close()
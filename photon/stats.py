@@ -14,6 +14,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+
+
 class TrafficStats:
     def __init__(self):
         self.packageHeaderSize = 0
@@ -27,6 +30,11 @@ class TrafficStats:
         self.unreliableCommandBytes = 0
         self.fragmentCommandBytes = 0
         self.controlCommandBytes = 0
+        self.pingCount = 0
+        self.opCodeCounts = {}
+        self.opCodeBytes = {}
+        self.eventCodeCounts = {}
+        self.eventCodeBytes = {}
 
     def total_command_count(self):
         return self.reliableCommandCount + self.unreliableCommandCount + \
@@ -55,7 +63,247 @@ class TrafficStats:
         self.fragmentCommandBytes += size
         self.fragmentCommandCount += 1
 
+    def count_ping(self, size):
+        self.count_control_command(size)
+        self.pingCount += 1
+
+    def count_operation(self, op_code, size, reliable):
+        """
+        Counts operation request (outgoing) or response (incoming).
+        """
+        if reliable:
+            self.count_reliable_op_command(size)
+        else:
+            self.count_unreliable_op_command(size)
+
+        self.opCodeCounts[op_code] = self.opCodeCounts.get(op_code, 0) + 1
+        self.opCodeBytes[op_code] = self.opCodeBytes.get(op_code, 0) + size
+
+    def count_event(self, code, size):
+        self.count_reliable_op_command(size)
+
+        self.eventCodeCounts[code] = self.eventCodeCounts.get(code, 0) + 1
+        self.eventCodeBytes[code] = self.eventCodeBytes.get(code, 0) + size
+
+    def copy(self):
+        stats = TrafficStats()
+        stats.__dict__.update(self.__dict__)
+
+        for name in ("opCodeCounts", "opCodeBytes", "eventCodeCounts", "eventCodeBytes"):
+            setattr(stats, name, dict(getattr(self, name)))
+
+        return stats
+
     def __str__(self, *args, **kwargs):
         return "TotalPacketBytes: {}\nTotalCommandBytes: {}\nTotalPacketCount: {}\nTotalCommandsInPackets: {}" \
             .format(self.total_packet_bytes(), self.total_command_bytes(),
-                    self.totalPacketCount, self.totalCommandsInPackets)
\ No newline at end of file
+                    self.totalPacketCount, self.totalCommandsInPackets)
+
+
+class DispatchCounter:
+    __slots__ = ("delivered", "dropped")
+
+    def __init__(self, delivered=0, dropped=0):
+        self.delivered = delivered
+        self.dropped = dropped
+
+    def __str__(self, *args, **kwargs):
+        return "Delivered: {}, Dropped: {}".format(self.delivered, self.dropped)
+
+
+class SendStats:
+    """
+    Counters of outgoing flushes: how many messages and bytes left and in how many send syscalls,
+    and how long (in seconds) messages waited in queue before being sent.
+    """
+    __slots__ = ("flushes", "messages", "bytes", "syscalls",
+                 "last_flush_messages", "last_flush_bytes", "last_flush_syscalls",
+                 "waited", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.flushes = 0
+        self.messages = 0
+        self.bytes = 0
+        self.syscalls = 0
+        self.last_flush_messages = 0
+        self.last_flush_bytes = 0
+        self.last_flush_syscalls = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def count_flush(self, messages, sent_bytes, syscalls):
+        self.flushes += 1
+        self.messages += messages
+        self.bytes += sent_bytes
+        self.syscalls += syscalls
+        self.last_flush_messages = messages
+        self.last_flush_bytes = sent_bytes
+        self.last_flush_syscalls = syscalls
+
+    def count_wait(self, wait):
+        self.waited += 1
+        self.wait_total += wait
+
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+    def average_wait(self):
+        return self.wait_total / self.waited if self.waited else 0.0
+
+    def copy(self):
+        stats = SendStats()
+        for name in SendStats.__slots__:
+            setattr(stats, name, getattr(self, name))
+
+        return stats
+
+    def __str__(self, *args, **kwargs):
+        return "Flushes: {}, Messages: {}, Bytes: {}, Syscalls: {}, AverageWait: {:.6f}, MaxWait: {:.6f}".format(
+            self.flushes, self.messages, self.bytes, self.syscalls, self.average_wait(), self.wait_max)
+
+
+# values are kept in microseconds, in buckets of 2 ** _SUB_BUCKET_BITS linear steps per power of two,
+# so every recorded value is within about 6% of its bucket's value
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_MAX_VALUE = (1 << 40) - 1
+
+
+def _bucket_index(value):
+    if value < _SUB_BUCKETS:
+        return value
+
+    shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+    return (shift + 1) * _SUB_BUCKETS + (value >> shift) - _SUB_BUCKETS
+
+
+def _bucket_value(index):
+    """
+    Middle of the bucket's value range.
+    """
+    if index < _SUB_BUCKETS:
+        return index
+
+    shift = index // _SUB_BUCKETS - 1
+    low = (index % _SUB_BUCKETS + _SUB_BUCKETS) << shift
+    return low + ((1 << shift) - 1) / 2
+
+
+_BUCKET_COUNT = _bucket_index(_MAX_VALUE) + 1
+
+
+class LatencyHistogram:
+    """
+    Fixed size histogram of latencies in milliseconds with logarithmic buckets (about 6% precision,
+    from a microsecond up to 12 days). Histograms of many peers can be merged.
+    """
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * _BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+
+        self.counts[_bucket_index(min(int(value * 1000), _MAX_VALUE))] += 1
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Returns latency (ms) below which percent of recorded values are, None if nothing was recorded.
+        """
+        if self.count == 0:
+            return None
+
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(_bucket_value(index) / 1000, self.min), self.max)
+
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max,
+        }
+
+    def merge(self, other):
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def copy(self):
+        histogram = LatencyHistogram()
+        histogram.merge(self)
+
+        return histogram
+
+    def __str__(self, *args, **kwargs):
+        return "Count: {count}, Min: {min}, Mean: {mean}, P50: {p50}, P90: {p90}, P99: {p99}, P999: {p999}, " \
+               "Max: {max}".format(**self.summary())
+
+
+class ResponseTimer:
+    """
+    Matches operation responses to requests by op code, in order, and records time between sending a request
+    and receiving its response per op code. At most max_pending unanswered requests per op code are remembered.
+    """
+
+    def __init__(self, max_pending=1024):
+        self.max_pending = max_pending
+        self.pending = {}
+        self.histograms = {}
+
+    def request_sent(self, op_code, now):
+        pending = self.pending.get(op_code)
+        if pending is None:
+            pending = self.pending[op_code] = collections.deque(maxlen=self.max_pending)
+
+        pending.append(now)
+
+    def response_received(self, op_code, now):
+        pending = self.pending.get(op_code)
+        if not pending:
+            return
+
+        histogram = self.histograms.get(op_code)
+        if histogram is None:
+            histogram = self.histograms[op_code] = LatencyHistogram()
+
+        histogram.record((now - pending.popleft()) * 1000)
@@ -15,11 +15,68 @@ limitations under the License.
 """
 
 from _socket import timeout
+import os
 import socket
 import threading
+import time
 import traceback
-from photon.enums import DebugLevel, StatusCode
-from photon.utils import print_array
+from photon.enums import DebugLevel, StatusCode, TraceStage
+from photon.framing import HEADER_SIZE, split_frames
+
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+
+if _IOV_MAX <= 0:
+    _IOV_MAX = 16
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+def send_messages(sock, messages, stats):
+    """
+    Writes messages with as few syscalls as possible: sendmsg gathers up to IOV_MAX of them per call,
+    where it is missing they are joined and sent as one buffer. Partial writes are continued from
+    where they stopped. On a non-blocking socket stops when it would block and returns the unsent tail
+    (its first item may be a memoryview of a partly sent message), otherwise returns an empty list.
+    """
+    if _HAS_SENDMSG:
+        pending = list(messages)
+        per_item = 1
+    else:
+        pending = [b"".join(messages)]
+        per_item = len(messages)
+
+    sent_messages = 0
+    sent_bytes = 0
+    syscalls = 0
+
+    try:
+        while pending:
+            if _HAS_SENDMSG:
+                sent = sock.sendmsg(pending[:_IOV_MAX])
+            else:
+                sent = sock.send(pending[0])
+
+            syscalls += 1
+            sent_bytes += sent
+
+            done = 0
+            while done < len(pending) and sent >= len(pending[done]):
+                sent -= len(pending[done])
+                done += 1
+
+            sent_messages += done * per_item
+            pending = pending[done:]
+            if sent:
+                pending[0] = memoryview(pending[0])[sent:]
+    except BlockingIOError:
+        pass
+    finally:
+        stats.count_flush(sent_messages, sent_bytes, syscalls)
+
+    return pending
 
 
 class TConnect:
@@ -43,7 +100,7 @@ class TConnect:
             self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         except Exception as e:
             if self.pp.debug_level >= DebugLevel.Error:
-                self.pp.peer_listener.debug_return(DebugLevel.ERROR, e)
+                self.pp.log(DebugLevel.Error, e)
             self.pp.peer_listener.on_status_changed(StatusCode.ExceptionOnConnect)
             self.pp.peer_listener.on_status_changed(StatusCode.Disconnect)
 
@@ -57,94 +114,107 @@ class TConnect:
 
         return True
 
+    def is_writable(self):
+        return True
+
     def send_tcp(self, data):
+        self.send_batch([data])
+
+    def send_batch(self, messages):
         if self.obsolete:
             if self.pp.debug_level >= DebugLevel.Info:
-                self.pp.peer_listener.debug_return(DebugLevel.Info,
-                                                   "Sending was skipped because connection is obsolete.")
+                self.pp.log(DebugLevel.Info, "Sending was skipped because connection is obsolete.",
+                            messages=len(messages))
 
             return
 
+        capture = self.pp.capture
+        if capture is not None:
+            for data in messages:
+                capture.outgoing(data)
+
         try:
-            self.connection.send(data)
+            send_messages(self.connection, messages, self.pp.send_stats)
         except Exception as e:
             if not self.obsolete:
                 self.obsolete = True
 
             if self.pp.debug_level >= DebugLevel.Error:
-                self.pp.enqueue_debug_return(DebugLevel.Error,
-                                             "TCP send failed. Exception: " + e)
+                self.pp.enqueue_debug_return(DebugLevel.Error, "TCP send failed. Exception: {}", e)
 
             traceback.print_exc()
 
     def stop_connection(self):
         if self.connection_thread is not None:
             self.obsolete = True
+
+            try:
+                # close() alone doesn't wake up a thread blocked in recv_into()
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
             self.connection.close()
-            self.connection_thread.join()
+
+            if self.connection_thread is not threading.current_thread():
+                self.connection_thread.join()
 
     def connection_thread_run(self):
         self.connection.connect((self.host, self.port))
 
         self.is_connected = True
+        self.pp.notify_service()
+
+        # frames are read in chunks as large as the free space allows, complete ones are handed out
+        # and a trailing partial frame is moved to the front before the next read
+        buffer = memoryview(bytearray(max(self.pp.receive_buffer_size, HEADER_SIZE)))
+        start = 0
+        end = 0
 
         while self.obsolete is False:
             try:
-                bytes_read = 0
-                to_read = 9
-                in_buff = bytearray([0] * 9)
-                buff_pointer = memoryview(in_buff)
-
-                while to_read:
-                    nbytes = self.connection.recv_into(buff_pointer, to_read)
-                    buff_pointer = buff_pointer[nbytes:]
-                    to_read -= nbytes
-                    bytes_read += nbytes
-
-                if bytes_read >= 9:
-                    op_collection = bytearray()
-
-                    if in_buff[0] == 256 - 16:
-                        self.pp.receive_incoming_commands(in_buff)
+                if end == len(buffer):
+                    if start:
+                        buffer[:end - start] = buffer[start:end]
                     else:
-                        length1 = 0xFF & in_buff[1]
-                        length2 = 0xFF & in_buff[2]
-                        length3 = 0xFF & in_buff[3]
-                        length4 = 0xFF & in_buff[4]
+                        grown = memoryview(bytearray(len(buffer) * 2))
+                        grown[:end] = buffer
+                        buffer = grown
+
+                    end -= start
+                    start = 0
 
-                        length = length1 << 24 | length2 << 16 | length3 << 8 | length4
+                nbytes = self.connection.recv_into(buffer[end:])
+                if nbytes == 0:
+                    raise ConnectionResetError("Connection closed by remote host")
 
-                        if self.pp.debug_level >= DebugLevel.All:
-                            self.pp.enqueue_debug_return(DebugLevel.All, "message length: {}".format(length))
+                end += nbytes
 
-                        op_collection.extend(in_buff[7:])
+                if self.pp.traffic_stats_enabled:
+                    self.pp.traffic_stats_incoming.totalPacketCount += 1
 
-                        bytes_read = 0
-                        length -= 9
-                        to_read = length
-                        in_buff = bytearray([0] * length)
-                        buff_pointer = memoryview(in_buff)
+                hooks = self.pp.trace_hooks
+                if hooks:
+                    received = time.perf_counter_ns()
 
-                        while to_read:
-                            nbytes = self.connection.recv_into(buff_pointer, to_read)
-                            buff_pointer = buff_pointer[nbytes:]
-                            to_read -= nbytes
-                            bytes_read += nbytes
+                capture = self.pp.capture
+                start = split_frames(buffer, start, end, self.pp.receive_incoming_commands,
+                                     capture.incoming if capture is not None else None)
 
-                        op_collection.extend(in_buff[0:bytes_read])
+                if hooks:
+                    self.pp.trace(TraceStage.Receive, received, time.perf_counter_ns(), nbytes)
 
-                        if len(op_collection):
-                            self.pp.receive_incoming_commands(op_collection)
+                if start == end:
+                    start = end = 0
             except timeout:
                 if (not self.obsolete) and (self.pp.debug_level >= DebugLevel.All):
-                    self.pp.enqueue_debug_return(DebugLevel.ALL, "TCP Receive timeout. All ok, just wait again.")
-            except OSError as e:
+                    self.pp.enqueue_debug_return(DebugLevel.All, "TCP Receive timeout. All ok, just wait again.")
+            except (OSError, ValueError) as e:
                 if not self.obsolete:
                     self.obsolete = True
 
                     if self.pp.debug_level >= DebugLevel.Error:
-                        self.pp.enqueue_debug_return(DebugLevel.Error,
-                                                     "Receiving failed. SocketException: {}".format(e))
+                        self.pp.enqueue_debug_return(DebugLevel.Error, "Receiving failed. SocketException: {}", e)
 
         self.is_connected = False
-        self.connection.close()
\ No newline at end of file
+        self.connection.close()
@@ -14,12 +14,17 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
 import threading
+import time
 import traceback
 from photon.basepeer import BasePeer
-from photon.enums import ConnectionState, DebugLevel, StatusCode
+from photon.channels import OutgoingChannel, schedule, send_delay
+from photon.enums import ConnectionState, DebugLevel, StatusCode, TraceStage
+from photon.framing import PAYLOAD_OFFSET
 from photon.operations import OperationRequest
-from photon.protocol import serialize_op_request
+from photon.protocol import OperationTemplate, calc_size, serialize_into
+from photon.stats import SendStats, TrafficStats
 from photon.support import SupportClass
 from photon.tconnect import TConnect
 from photon.utils import now_in_millis, print_array
@@ -30,24 +35,49 @@ class TPeer(BasePeer):
         super().__init__(peer_listener)
 
         self._rt = None
-        self.incoming_list = []
+        self.connection_factory = TConnect
+        self.incoming_list = collections.deque()
         self.incoming_list_lock = threading.Lock()
-        self.outgoing_op_list = []
+        self.outgoing_channels = []
+        self.outgoing_lock = threading.Lock()
+        self.outgoing_space = threading.Condition(self.outgoing_lock)
+        self.outgoing_count = 0
+        self.outgoing_bytes = 0
+        self.outgoing_max_bytes_per_flush = None
+        self.outgoing_rate_limit = None
+        self.outgoing_send_at = None
+        self.outgoing_max_messages = None
+        self.outgoing_max_bytes = None
+        self.outgoing_high_watermark = 0.8
+        self.outgoing_low_watermark = 0.5
+        self.outgoing_drop_unreliable = False
+        self.outgoing_warned = False
+        self.send_stats = SendStats()
+        self.traffic_stats_incoming = TrafficStats()
+        self.traffic_stats_outgoing = TrafficStats()
 
         self.last_ping_result = 0
         self.ping_request = bytearray([256 - 16, 0, 0, 0, 0])
         self.tcp_head = bytearray([256 - 5, 0, 0, 0, 0, 0, 0, 256 - 13, 2])
         self.message_head = self.tcp_head[:]
 
+        self.buffer_pool = []
+        self.buffer_pool_lock = threading.Lock()
+        self.buffer_pool_max = 64
+        self.buffer_min_size = 256
+
+        self.receive_buffer_size = 65536
+        # CaptureWriter of the connection, see PhotonPeer.start_capture
+        self.capture = None
+
         super().init_once()
 
     def connect(self, host, port, app_id=None):
         if self._state != ConnectionState.Disconnected and self.debug_level >= DebugLevel.Warning:
-            self.peer_listener.debug_return(DebugLevel.Warning,
-                                            "Connect() can't be called if peer is not Disconnected. Not connecting.")
+            self.log(DebugLevel.Warning, "Connect() can't be called if peer is not Disconnected. Not connecting.")
 
         if self.debug_level >= DebugLevel.All:
-            self.peer_listener.debug_return(DebugLevel.All, "Connect()")
+            self.log(DebugLevel.All, "Connect()", host=host, port=port)
 
         self.init_peer()
 
@@ -60,7 +90,7 @@ class TPeer(BasePeer):
 
         self._state = ConnectionState.Connecting
 
-        self._rt = TConnect(self, host, port)
+        self._rt = self.connection_factory(self, host, port)
         if self._rt.start_connection() is not True:
             self._state = ConnectionState.Disconnected
             return False
@@ -76,10 +106,10 @@ class TPeer(BasePeer):
             return
 
         if self.debug_level >= DebugLevel.All:
-            self.peer_listener.debug_return(DebugLevel.All, "Disconnect()")
+            self.log(DebugLevel.All, "Disconnect()")
 
         self._state = ConnectionState.Disconnecting
-        self.outgoing_op_list[:] = []
+        self.clear_outgoing()
 
         self._rt.stop_connection()
 
@@ -89,8 +119,29 @@ class TPeer(BasePeer):
     def init_peer(self):
         BasePeer.init_peer(self)
 
-        self.incoming_list = []
-        self.outgoing_op_list = []
+        self.incoming_list = collections.deque()
+        self.clear_outgoing()
+
+    def clear_outgoing(self):
+        with self.outgoing_lock:
+            for channel in self.outgoing_channels:
+                for data in channel.messages:
+                    self.release_buffer(data)
+
+                channel.clear()
+
+            self.outgoing_count = 0
+            self.outgoing_bytes = 0
+            self.outgoing_removed()
+
+    def outgoing_channel(self, channel_id):
+        """
+        Returns queue of the channel, creating missing ones. Must be called with outgoing_lock held.
+        """
+        while len(self.outgoing_channels) <= channel_id:
+            self.outgoing_channels.append(OutgoingChannel())
+
+        return self.outgoing_channels[channel_id]
 
     def enqueue_init(self):
         tcp_header = bytearray([256 - 5, 0, 0, 0, 0, 0, 1])
@@ -101,36 +152,198 @@ class TPeer(BasePeer):
 
         self.enqueue_message_as_payload(True, message, 0)
 
-    def enqueue_message_as_payload(self, reliable, op_message, channel_id):
+    def enqueue_message_as_payload(self, reliable, op_message, channel_id, block=False, timeout=None,
+                                   coalesce_key=None):
+        """
+        An unreliable message with coalesce_key replaces a still queued one with the same key (keeping its place
+        in the queue), so only the latest value is sent.
+        """
         if op_message is None:
             return False
 
         op_message[5] = channel_id
         op_message[6] = 1 if reliable else 0
 
-        self.outgoing_op_list.append(op_message)
+        if reliable:
+            coalesce_key = None
+
+        if coalesce_key is not None:
+            with self.outgoing_lock:
+                replaced = self.outgoing_channel(channel_id).replace(coalesce_key, op_message)
+
+                if replaced is not None:
+                    self.outgoing_bytes += len(op_message) - len(replaced)
+
+            if replaced is not None:
+                self.release_buffer(replaced)
+                return True
+
+        status = None
+        with self.outgoing_lock:
+            queued = self.make_outgoing_room(len(op_message), reliable, block, timeout)
+
+            if queued:
+                self.outgoing_channel(channel_id).append(op_message, coalesce_key)
+                self.outgoing_count += 1
+                self.outgoing_bytes += len(op_message)
+
+                if not self.outgoing_warned and self.outgoing_above(self.outgoing_high_watermark):
+                    self.outgoing_warned = True
+                    status = StatusCode.QueueOutgoingReliableWarning if reliable \
+                        else StatusCode.QueueOutgoingUnreliableWarning
+            else:
+                status = StatusCode.QueueOutgoingReliableError if reliable \
+                    else StatusCode.QueueOutgoingUnreliableWarning
+
+        if queued:
+            self.notify_service()
+        else:
+            self.release_buffer(op_message)
+
+            if self.debug_level >= DebugLevel.Warning:
+                self.enqueue_debug_return(DebugLevel.Warning,
+                                          "Outgoing queue is full ({} messages, {} bytes), op was not queued",
+                                          self.outgoing_count, self.outgoing_bytes, channel_id=channel_id,
+                                          size=len(op_message))
+
+        if status is not None:
+            self.enqueue_status_callback(status)
+
+        return queued
+
+    def make_outgoing_room(self, size, reliable, block, timeout):
+        """
+        Checks outgoing queue limits for a message of size bytes, dropping queued unreliable messages
+        or waiting for a flush if configured so. Must be called with outgoing_lock held.
+        """
+        if self.outgoing_has_room(size):
+            return True
+
+        if self.outgoing_drop_unreliable:
+            if not reliable:
+                return False
+
+            for channel in self.outgoing_channels:
+                for data in channel.drop_unreliable():
+                    self.outgoing_count -= 1
+                    self.outgoing_bytes -= len(data)
+                    self.release_buffer(data)
+
+            self.outgoing_removed()
+
+            if self.outgoing_has_room(size):
+                return True
+
+        if block:
+            self.outgoing_space.wait_for(
+                lambda: self.outgoing_has_room(size) or self._state != ConnectionState.Connected, timeout)
+
+            return self.outgoing_has_room(size)
+
+        return False
+
+    def outgoing_has_room(self, size):
+        if self.outgoing_count == 0:
+            return True
+
+        if self.outgoing_max_messages is not None and self.outgoing_count >= self.outgoing_max_messages:
+            return False
+
+        if self.outgoing_max_bytes is not None and self.outgoing_bytes + size > self.outgoing_max_bytes:
+            return False
 
         return True
 
-    def enqueue_operation(self, op_code, params, reliable, channel_id, encrypt, message_type=2):
+    def outgoing_above(self, fraction):
+        if self.outgoing_max_messages is not None and \
+                self.outgoing_count >= self.outgoing_max_messages * fraction:
+            return True
+
+        return self.outgoing_max_bytes is not None and self.outgoing_bytes >= self.outgoing_max_bytes * fraction
+
+    def outgoing_removed(self):
+        """
+        Rearms watermark warning and wakes waiting senders after messages left outgoing queue.
+        Must be called with outgoing_lock held.
+        """
+        if self.outgoing_warned and not self.outgoing_above(self.outgoing_low_watermark):
+            self.outgoing_warned = False
+
+        self.outgoing_space.notify_all()
+
+    def enqueue_operation(self, op_code, params, reliable, channel_id, encrypt, message_type=2, reuse_buffer=False,
+                          block=False, timeout=None, coalesce_key=None):
+        if not self.can_enqueue(op_code, channel_id):
+            return False
+
+        if coalesce_key is not None:
+            coalesce_key = (channel_id, op_code, coalesce_key)
+
+        if self.trace_hooks:
+            start = time.perf_counter_ns()
+            op_bytes = self.serialize_operation_to_message(op_code, params, encrypt, message_type, reuse_buffer)
+            serialized = time.perf_counter_ns()
+            size = len(op_bytes) if op_bytes is not None else 0
+            queued = self.enqueue_message_as_payload(reliable, op_bytes, channel_id, block, timeout, coalesce_key)
+
+            self.trace(TraceStage.Serialize, start, serialized, size, op_code)
+            self.trace(TraceStage.Enqueue, start, time.perf_counter_ns(), size, op_code)
+
+            return queued
+
+        op_bytes = self.serialize_operation_to_message(op_code, params, encrypt, message_type, reuse_buffer)
+        return self.enqueue_message_as_payload(reliable, op_bytes, channel_id, block, timeout, coalesce_key)
+
+    def create_operation_template(self, op_code, params, fields):
+        template = OperationTemplate(OperationRequest(op_code, params), fields, self.message_head)
+        SupportClass.int_to_byte_array(template.buffer, 1, len(template.buffer))
+
+        return template
+
+    def enqueue_template(self, template, reliable, channel_id, reuse_buffer=False, block=False, timeout=None,
+                         coalesce_key=None):
+        op_code = template.buffer[len(self.message_head)]
+        if not self.can_enqueue(op_code, channel_id):
+            return False
+
+        if coalesce_key is not None:
+            coalesce_key = (channel_id, op_code, coalesce_key)
+
+        # read once, a hook may be added meanwhile
+        hooks = self.trace_hooks
+        if hooks:
+            start = time.perf_counter_ns()
+
+        if reuse_buffer:
+            op_bytes = self.acquire_buffer(len(template.buffer))
+            op_bytes[:] = template.buffer
+        else:
+            op_bytes = template.build()
+
+        queued = self.enqueue_message_as_payload(reliable, op_bytes, channel_id, block, timeout, coalesce_key)
+
+        if hooks:
+            self.trace(TraceStage.Enqueue, start, time.perf_counter_ns(), len(op_bytes),
+                       op_code - 256 if op_code > 127 else op_code)
+
+        return queued
+
+    def can_enqueue(self, op_code, channel_id):
         if self._state != ConnectionState.Connected:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error,
-                                                "Cannot send op: {}. Not connected. PeerState: {}".format(
-                                                    0xFF & op_code, self._state.name))
+                self.log(DebugLevel.Error, "Cannot send op: {}. Not connected. PeerState: {}",
+                         0xFF & op_code, self._state.name, op_code=op_code)
             self.peer_listener.on_status_changed(StatusCode.SendError)
             return False
 
-        if channel_id > self.m_channelCount:
+        if channel_id < 0 or channel_id >= self.m_channelCount:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error,
-                                                "Cannot send op: Selected channel ({})>= channelCount ({})".format(
-                                                    channel_id, self.m_channelCount))
+                self.log(DebugLevel.Error, "Cannot send op: Selected channel ({})>= channelCount ({})",
+                         channel_id, self.m_channelCount, op_code=op_code, channel_id=channel_id)
             self.peer_listener.on_status_changed(StatusCode.SendError)
             return False
 
-        op_bytes = self.serialize_operation_to_message(op_code, params, encrypt, message_type)
-        return self.enqueue_message_as_payload(reliable, op_bytes, channel_id)
+        return True
 
     def send_outgoing_commands(self):
         if self._state == ConnectionState.Disconnected:
@@ -143,62 +356,214 @@ class TPeer(BasePeer):
                         self.get_local_ms_timestamp() - self.last_ping_result > self.m_time_ping_interval):
             self.send_ping()
 
-        if len(self.outgoing_op_list) > 0:
-            to_send = list(self.outgoing_op_list)
-            self.outgoing_op_list[:] = []
+        if not self._rt.is_writable():
+            # connection still has unsent data, the rest waits here where queue limits apply
+            return True
+
+        with self.outgoing_lock:
+            if self.outgoing_count == 0:
+                self.outgoing_send_at = None
+                return True
+
+            enqueued = [] if self.trace_hooks else None
+            to_send = schedule(self.outgoing_channels, self.outgoing_max_bytes_per_flush, self.outgoing_rate_limit,
+                               self.send_stats, enqueued)
+            self.outgoing_count -= len(to_send)
+            self.outgoing_bytes -= sum(len(data) for data in to_send)
+            self.outgoing_removed()
+
+            # with rate limits the rest may have to wait, get_service_timeout() tells service loop how long
+            delay = send_delay(self.outgoing_channels, self.outgoing_rate_limit)
+            self.outgoing_send_at = None if not delay else time.monotonic() + delay
+            more = delay == 0
+
+        if to_send:
+            if self.traffic_stats_enabled:
+                self.count_outgoing_traffic(to_send)
+
+            if self.response_times_enabled:
+                # before sending, the response may arrive on the connection thread before send_data returns
+                now = time.perf_counter()
+                for data in to_send:
+                    if data[8] & 0x7F == 2:
+                        self.response_timer.request_sent(data[9] - 256 if data[9] > 127 else data[9], now)
+
+            if enqueued is not None:
+                self.trace_queue_wait(to_send, enqueued)
+                start = time.perf_counter_ns()
+
+            # whole batch leaves in one go (see tconnect.send_messages)
+            self.send_data(to_send)
+
+            if enqueued is not None:
+                self.trace(TraceStage.Send, start, time.perf_counter_ns(), sum(len(data) for data in to_send))
 
             for data in to_send:
-                self.send_data(data)
+                self.release_buffer(data)
+
+        if more:
+            # per flush limits left something that can go right away
+            self.notify_service()
 
         return True
 
+    def trace_queue_wait(self, messages, enqueued):
+        now = time.perf_counter_ns()
+
+        for data, enqueued_ns in zip(messages, enqueued):
+            code = None
+            if data[8] & 0x7F == 2:
+                code = data[9] - 256 if data[9] > 127 else data[9]
+
+            self.trace(TraceStage.QueueWait, enqueued_ns, now, len(data), code)
+
+    def get_service_timeout(self):
+        """
+        Seconds until send_outgoing_commands() has to run to keep pinging the server
+        or to send ops held back by rate limits.
+        """
+        if self._state != ConnectionState.Connected or self._rt is None or not self._rt.is_running():
+            return self.m_time_ping_interval / 1000.0
+
+        due = max(self.last_ping_result + self.m_time_ping_interval - self.get_local_ms_timestamp(), 0) / 1000.0
+
+        send_at = self.outgoing_send_at
+        if send_at is not None:
+            due = min(due, max(send_at - time.monotonic(), 0))
+
+        return due
+
+    def count_outgoing_traffic(self, messages):
+        stats = self.traffic_stats_outgoing
+        stats.totalPacketCount += 1
+        stats.totalCommandsInPackets += len(messages)
+
+        for data in messages:
+            # op request: header is followed by op code, init message has no type in byte 8
+            if data[8] & 0x7F == 2:
+                stats.count_operation(data[9] - 256 if data[9] > 127 else data[9], len(data), data[6] == 1)
+            else:
+                stats.count_control_command(len(data))
+
     def send_ping(self):
         time = self.get_local_ms_timestamp()
         SupportClass.int_to_byte_array(self.ping_request, 1, time)
         self.last_ping_result = self.get_local_ms_timestamp()
 
-        self.send_data(self.ping_request)
+        if self.traffic_stats_enabled:
+            self.traffic_stats_outgoing.count_ping(len(self.ping_request))
+
+        # a copy, connection may keep unsent data while ping_request is reused
+        self.send_data([bytes(self.ping_request)])
 
-    def send_data(self, data):
+    def send_data(self, messages):
         try:
-            self._rt.send_tcp(data)
+            self._rt.send_batch(messages)
         except Exception as e:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error, e)
+                self.log(DebugLevel.Error, e)
 
             traceback.print_exc()
 
     def dispatch_incoming_commands(self):
-        with self._action_queue_lock:
-            while len(self._action_queue) > 0:
-                self._action_queue.pop(0)()
+        self.dispatch_actions()
 
-        with self.incoming_list_lock:
+        with self.locked(self.incoming_list_lock, TraceStage.IncomingLockWait):
             if len(self.incoming_list) <= 0:
                 return False
 
-            payload = self.incoming_list.pop(0)
+            payload = self.incoming_list.popleft()
+
+        self.deserialize_message_and_callback(payload)
+
+        return True
+
+    def dispatch_incoming_batch(self, max_count=None):
+        """
+        Takes up to max_count (all if None) pending messages under one lock acquisition and dispatches them.
+        Returns number of dispatched messages.
+        """
+        self.dispatch_actions()
 
-        return self.deserialize_message_and_callback(payload)
+        with self.locked(self.incoming_list_lock, TraceStage.IncomingLockWait):
+            if len(self.incoming_list) <= 0:
+                return 0
+
+            if max_count is None or len(self.incoming_list) <= max_count:
+                batch = self.incoming_list
+                self.incoming_list = collections.deque()
+            else:
+                popleft = self.incoming_list.popleft
+                batch = [popleft() for i in range(max_count)]
+
+        if self.trace_hooks:
+            start = time.perf_counter_ns()
+
+            for payload in batch:
+                self.deserialize_message_and_callback(payload)
+
+            self.trace(TraceStage.Dispatch, start, time.perf_counter_ns(), len(batch))
+        else:
+            for payload in batch:
+                self.deserialize_message_and_callback(payload)
+
+        return len(batch)
 
     def receive_incoming_commands(self, data):
         if data is None:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error, "receive_incoming_commands() - data is None")
+                self.log(DebugLevel.Error, "receive_incoming_commands() - data is None")
 
             return
 
+        if self.traffic_stats_enabled:
+            self.count_incoming_traffic(data)
+
+        if self.response_times_enabled and data[0] == 256 - 13 and len(data) > 2 and data[1] & 0x7F == 3:
+            self.response_timer.response_received(data[2] - 256 if data[2] > 127 else data[2], time.perf_counter())
+
+        item = data
+        if self.trace_hooks:
+            now = time.perf_counter_ns()
+            self.trace(TraceStage.FrameComplete, now, now, len(data), self.message_code(data))
+
+            # dispatching reports how long it waited
+            item = (data, now)
+
         if data[0] == 256 - 13 or data[0] == 256 - 12:
-            with self.incoming_list_lock:
-                self.incoming_list.append(data)
+            with self.locked(self.incoming_list_lock, TraceStage.IncomingLockWait):
+                self.incoming_list.append(item)
                 if len(self.incoming_list) % self.m_warningSize == 0:
                     self.enqueue_status_callback(StatusCode.QueueIncomingReliableWarning)
+
+            self.notify_service()
         elif data[0] == 256 - 16:
             self.read_ping_result(data)
         elif self.debug_level >= DebugLevel.Error:
             self.enqueue_debug_return(DebugLevel.Error,
-                                      "receiveIncomingCommands() MagicNumber should be 0xF0, 0xF3 or 0xF4. Is: {:02x}"
-                                      .format(data[0]))
+                                      "receiveIncomingCommands() MagicNumber should be 0xF0, 0xF3 or 0xF4. Is: {:02x}",
+                                      data[0], size=len(data))
+
+    def count_incoming_traffic(self, data):
+        """
+        Counts message given to receive_incoming_commands, its size includes the stripped frame header.
+        """
+        stats = self.traffic_stats_incoming
+        stats.totalCommandsInPackets += 1
+
+        if data[0] == 256 - 16:
+            stats.count_ping(len(data))
+            return
+
+        size = len(data) + PAYLOAD_OFFSET
+        msg_type = data[1] & 0x7F if len(data) > 2 else 0
+
+        if msg_type == 3:
+            stats.count_operation(data[2] - 256 if data[2] > 127 else data[2], size, True)
+        elif msg_type == 4:
+            stats.count_event(data[2] - 256 if data[2] > 127 else data[2], size)
+        else:
+            stats.count_control_command(size)
 
     def read_ping_result(self, payload):
         server_sent_time = int.from_bytes(payload[1:5], "big")
@@ -207,23 +572,47 @@ class TPeer(BasePeer):
         self.m_lastRoundTripTime = (self.get_local_ms_timestamp() - client_sent_time)
         self.update_round_trip_time_and_variance(self.m_lastRoundTripTime)
 
-    def serialize_operation_to_message(self, op_code, params, encrypt, message_type):
+    def serialize_operation_to_message(self, op_code, params, encrypt, message_type, reuse_buffer=False):
         op_request = OperationRequest(op_code, params)
-        op_bytes = serialize_op_request(op_request)
         full_message = None
 
-        if op_bytes is not None and len(op_bytes) > 0:
+        try:
+            head_size = len(self.message_head)
+            size = head_size + calc_size(op_request, False)
+
             if encrypt:
                 pass
                 # here encrypt data
 
-            full_message = bytearray()
-            full_message.extend(self.message_head)
-            full_message.extend(op_bytes)
+            full_message = self.acquire_buffer(size) if reuse_buffer else bytearray(size)
+            full_message[0:head_size] = self.message_head
+            serialize_into(full_message, head_size, op_request)
+
+            SupportClass.int_to_byte_array(full_message, 1, size)
+        except Exception as e:
+            full_message = None
 
-            SupportClass.int_to_byte_array(full_message, 1, len(full_message))
-        else:
             if self.debug_level >= DebugLevel.Error:
-                self.peer_listener.debug_return(DebugLevel.Error, "Error serializing operation! {}".format(op_request))
+                self.log(DebugLevel.Error, "Error serializing operation! {}: {}", op_request, e)
 
         return full_message
+
+    def acquire_buffer(self, size):
+        """
+        Returns a memoryview of exactly size bytes over a pooled buffer.
+        The buffer goes back to the pool in release_buffer() once the message is sent.
+        """
+        with self.buffer_pool_lock:
+            for i in range(len(self.buffer_pool) - 1, -1, -1):
+                if len(self.buffer_pool[i]) >= size:
+                    return memoryview(self.buffer_pool.pop(i))[:size]
+
+        return memoryview(bytearray(max(size, self.buffer_min_size)))[:size]
+
+    def release_buffer(self, data):
+        if type(data) is not memoryview:
+            return
+
+        with self.buffer_pool_lock:
+            if len(self.buffer_pool) < self.buffer_pool_max:
+                self.buffer_pool.append(data.obj)
@@ -0,0 +1,173 @@
+"""
+Copyright 2015 Logvinenko Maksim
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+import threading
+import time
+from photon.enums import TraceStage
+from photon.stats import LatencyHistogram
+
+
+class TraceHook:
+    """
+    Base for hooks registered with PhotonPeer.add_trace_hook. on_stage is called with time.perf_counter_ns()
+    timestamps of a stage (TraceStage) from the thread that ran it:
+
+    - Enqueue: op_custom / op_template, serialization included; code is op code
+    - Serialize: serialization of an operation into a message; code is op code
+    - QueueWait: from enqueueing a message to taking it out of queue for sending; code is op code
+    - Send: writing a batch of messages to connection; size is batch bytes, code None
+    - Receive: connection handing over messages of one socket read; size is bytes read, code None
+    - FrameComplete: instant a message was received (start == end); code is event or op code
+    - IncomingWait: from FrameComplete to dispatching of the message; code is event or op code
+    - Decode: deserialization of an event or operation response; code is event or op code
+    - Callback: listener callback or registered handler; code is event or op code
+    - Dispatch: dispatching a batch of incoming messages; size is number of messages, code None
+    - SendLockWait, DispatchLockWait, IncomingLockWait: waiting for PhotonPeer.send_lock, PhotonPeer.dispatch_lock
+      or TPeer.incoming_list_lock; size 0, code None
+    """
+
+    def on_stage(self, stage, start_ns, end_ns, size, code):
+        pass
+
+
+class StageTimings(TraceHook):
+    """
+    Aggregates durations (LatencyHistogram, ms) and sizes per stage.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.sizes = {}
+
+    def on_stage(self, stage, start_ns, end_ns, size, code):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+                self.sizes[stage] = 0
+
+            histogram.record((end_ns - start_ns) / 1000000)
+            self.sizes[stage] += size
+
+    def snapshot(self):
+        """
+        Returns dict stage -> LatencyHistogram.
+        """
+        with self.lock:
+            return {stage: histogram.copy() for stage, histogram in self.histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.sizes = {}
+
+    def __str__(self, *args, **kwargs):
+        with self.lock:
+            return "\n".join("{}: {}, Bytes: {}".format(TraceStage(stage).name, self.histograms[stage], self.sizes[stage])
+                             for stage in sorted(self.histograms))
+
+
+class TracedLock:
+    """
+    Context manager acquiring lock and reporting time waited for it as stage, see BasePeer.locked.
+    """
+    __slots__ = ("peer", "lock", "stage")
+
+    def __init__(self, peer, lock, stage):
+        self.peer = peer
+        self.lock = lock
+        self.stage = stage
+
+    def __enter__(self):
+        start = time.perf_counter_ns()
+        self.lock.acquire()
+        self.peer.trace(self.stage, start, time.perf_counter_ns(), 0)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
+
+
+# waits overlap each other, they go as async spans (rows of their own) instead of spans of a thread
+_WAIT_STAGES = (TraceStage.QueueWait, TraceStage.IncomingWait)
+
+
+class ChromeTraceRecorder(TraceHook):
+    """
+    Records stages as Chrome trace events. save() writes JSON which chrome://tracing or https://ui.perfetto.dev
+    open: every thread gets a track of spans of stages it ran, queue waits are drawn as async spans.
+    Recording stops after max_events.
+    """
+
+    def __init__(self, max_events=1000000):
+        self.max_events = max_events
+
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+        self.dropped = 0
+        self.wait_id = 0
+        self.pid = os.getpid()
+
+    def on_stage(self, stage, start_ns, end_ns, size, code):
+        tid = threading.get_ident()
+        name = TraceStage(stage).name
+        args = {"size": size}
+
+        if code is not None:
+            name = "{} {}".format(name, code)
+            args["code"] = code
+
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+
+            if tid not in self.threads:
+                self.threads[tid] = threading.current_thread().name
+
+            if stage in _WAIT_STAGES:
+                self.wait_id += 1
+                event = {"name": name, "cat": "wait", "ph": "b", "id": self.wait_id, "pid": self.pid, "tid": tid,
+                         "ts": start_ns / 1000, "args": args}
+                self.events.append(event)
+                self.events.append({"name": name, "cat": "wait", "ph": "e", "id": self.wait_id, "pid": self.pid,
+                                    "tid": tid, "ts": end_ns / 1000})
+            elif stage == TraceStage.FrameComplete:
+                self.events.append({"name": name, "cat": "photon", "ph": "i", "s": "t", "pid": self.pid,
+                                    "tid": tid, "ts": start_ns / 1000, "args": args})
+            else:
+                self.events.append({"name": name, "cat": "photon", "ph": "X", "pid": self.pid, "tid": tid,
+                                    "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000, "args": args})
+
+    def to_json(self):
+        with self.lock:
+            names = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                     for tid, name in self.threads.items()]
+
+            return {"traceEvents": names + self.events, "displayTimeUnit": "ns",
+                    "otherData": {"dropped_events": self.dropped}}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f)
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+            self.dropped = 0
@@ -28,4 +28,12 @@ def now_in_millis():
     return int(round(time.time() * 1000))
 
 
+def signed_byte(value):
+    """
+    Event and op codes are signed bytes on the wire (as in EventData.code), 255 and -1 are the same code.
+    """
+    value &= 0xFF
+    return value - 256 if value > 127 else value
+
+
 